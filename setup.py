@@ -20,7 +20,8 @@ setuptools.setup(
     ],
     install_requires=[
         "matplotlib==3.5.0",
-        "networkx==2.6.3"
+        "networkx==2.6.3",
+        "numpy>=1.17"
     ],
     python_requires='>=3.7',
 )
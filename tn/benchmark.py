@@ -0,0 +1,121 @@
+from tn.circuit import *
+from tn.computation import *
+from tn.report import *
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class BenchmarkCase:
+    def __init__(self, n_blk, depth, obs_stt, obs_end, kind="var", mhalf=1, grad_id=None):
+        self.n_blk = n_blk
+        self.depth = depth
+        self.obs_stt = obs_stt
+        self.obs_end = obs_end
+        self.kind = kind
+        self.mhalf = mhalf
+        # the group in the middle of the circuit by default
+        self.grad_id = grad_id
+
+    def circuit(self):
+        return ALTGenerator.generate(self.n_blk, self.depth, self.obs_stt, self.obs_end)
+
+    def networks(self, circuit: Circuit):
+        grad_id = self.grad_id
+        if grad_id is None:
+            group_ids = [g.group_id for g in circuit.gates if g.type == Type.UNITARY]
+            grad_id = group_ids[len(group_ids) // 2]
+        if self.kind == "var":
+            return grad_id, circuit.to_grad_var(grad_id, self.mhalf)
+        elif self.kind == "avg":
+            return grad_id, circuit.to_grad_avg(grad_id, self.mhalf)
+        raise InvalidVariableException("kind should be var or avg")
+
+    def to_dict(self):
+        return {"n_blk": self.n_blk, "depth": self.depth, "obs_stt": self.obs_stt, "obs_end": self.obs_end,
+                "kind": self.kind, "mhalf": self.mhalf}
+
+
+class Benchmark:
+    # runs the pipeline Circuit.to_grad_var/avg -> HaarIntegration -> ReportBuilder.build for each case and records
+    # the wall time and the number of networks of each step, the peak RSS of the process and the allocations
+    def __init__(self, cases, merge=False, trace_allocations=True):
+        self.cases = cases
+        self.merge = merge
+        # tracemalloc slows down the computation, the times are not comparable with the runs without it
+        self.trace_allocations = trace_allocations
+
+    @classmethod
+    def default_cases(cls):
+        cases = []
+        for n_blk, depth in [(1, 2), (2, 2), (2, 3), (3, 3)]:
+            for obs_stt, obs_end in [(0, 0), (0, 1)]:
+                for kind in ["avg", "var"]:
+                    cases.append(BenchmarkCase(n_blk, depth, obs_stt, obs_end, kind))
+        return cases
+
+    def run(self):
+        return {"python": sys.version, "platform": platform.platform(), "merge": self.merge,
+                "trace_allocations": self.trace_allocations,
+                "results": [self.run_case(case) for case in self.cases]}
+
+    def run_case(self, case: BenchmarkCase):
+        if self.trace_allocations:
+            tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            circuit = case.circuit()
+            grad_id, networks = case.networks(circuit)
+            build_time = time.perf_counter() - start
+            n_steps = max(len(n.group_map) for n in networks.networks)
+            integration = HaarIntegration(n_steps, merge=self.merge)
+            steps = []
+            for s in range(n_steps):
+                start = time.perf_counter()
+                n_in = len(networks.networks)
+                networks = integration.step(networks)
+                steps.append({"step": s, "seconds": time.perf_counter() - start,
+                              "networks_in": n_in, "networks_out": len(networks.networks)})
+            start = time.perf_counter()
+            builder = ReportBuilder(networks).build()
+            report_time = time.perf_counter() - start
+            result = {"case": case.to_dict(), "grad_id": grad_id, "build_seconds": build_time, "steps": steps,
+                      "integration_seconds": sum(s["seconds"] for s in steps), "report_seconds": report_time,
+                      "networks": len(networks.networks), "report_networks": len(builder.merged_map),
+                      "kernel_cache": {"hits": integration.cache.hits, "misses": integration.cache.misses},
+                      "peak_rss_kb": self.peak_rss_kb()}
+            if self.trace_allocations:
+                current, peak = tracemalloc.get_traced_memory()
+                result["allocations"] = {"current_bytes": current, "peak_bytes": peak}
+            return result
+        finally:
+            if self.trace_allocations:
+                tracemalloc.stop()
+
+    def dump(self, path):
+        result = self.run()
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        return result
+
+    @classmethod
+    def peak_rss_kb(cls):
+        # the peak of the whole process so far, which is not reset between the cases
+        if resource is None:
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            # bytes on macOS
+            rss = rss // 1024
+        return rss
+
+
+if __name__ == '__main__':
+    Benchmark(Benchmark.default_cases()).dump(sys.argv[1] if len(sys.argv) > 1 else "benchmark.json")
@@ -0,0 +1,130 @@
+from tn.circuit import *
+from tn.computation import *
+from tn.serialization import *
+import hashlib
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    # exclusive lock on a file shared by the processes using the same cache directory
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+
+class ResultCache:
+    # content addressed cache of the results of HaarIntegration on Circuit.to_grad_var / to_grad_avg.
+    # the least recently used results are evicted when the total size exceeds max_bytes.
+    SUFFIX = ".tnns"
+
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        self.lock = FileLock(os.path.join(path, ".lock"))
+
+    def compute(self, circuit: Circuit, kind, grad_id, mhalf, integration: HaarIntegration) -> TensorNetworks:
+        key = self.key(circuit, kind, grad_id, mhalf, integration)
+        result = self.get(key)
+        if result is not None:
+            return result
+        if kind == "var":
+            networks = circuit.to_grad_var(grad_id, mhalf)
+        elif kind == "avg":
+            networks = circuit.to_grad_avg(grad_id, mhalf)
+        else:
+            raise InvalidVariableException("kind should be var or avg")
+        result = integration.compute(networks)
+        self.put(key, result)
+        return result
+
+    @classmethod
+    def key(cls, circuit: Circuit, kind, grad_id, mhalf, integration: HaarIntegration):
+        gates = [g.key() for g in circuit.gates]
+        # the settings which change the result. the pruned results are approximate, so they are kept apart from
+        # the exact ones. depth_first, workers, chunk_size, cache_size and observer only change how the result
+        # is computed, and are left out so that the runs with them share the entries
+        spec = [NetworksSerializer.VERSION, kind, repr(grad_id), mhalf, circuit.b_height, repr(gates),
+                repr(circuit.observable.key()), integration.n_steps, integration.merge,
+                integration.prune, integration.slack if integration.prune else 0]
+        return hashlib.sha256(repr(spec).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        file = self._file(key)
+        with self.lock:
+            if not os.path.exists(file):
+                return None
+            with open(file, "rb") as f:
+                data = f.read()
+            # the access time is kept in mtime for the eviction
+            os.utime(file)
+        try:
+            return NetworksSerializer.loads(data)
+        except SerializationException:
+            return None
+
+    def put(self, key, networks: TensorNetworks):
+        data = NetworksSerializer.dumps(networks)
+        with self.lock:
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._file(key))
+            self._evict(keep=key + self.SUFFIX)
+
+    def clear(self):
+        with self.lock:
+            for name in os.listdir(self.path):
+                if name.endswith(self.SUFFIX):
+                    os.remove(os.path.join(self.path, name))
+
+    def size(self):
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith(self.SUFFIX):
+                total = total + os.path.getsize(os.path.join(self.path, name))
+        return total
+
+    def _evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(self.SUFFIX):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            os.remove(os.path.join(self.path, name))
+            total = total - size
+
+    def _file(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
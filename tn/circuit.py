@@ -78,38 +78,63 @@ class Circuit:
     def add_observable(self, observable: Gate):
         self.observable = observable
 
-    def to_grad_var(self, grad_id, mhalf) -> TensorNetworks:
+    def light_cone(self, grad_id):
+        # gates which are not cancelled with their conjugates, i.e. the gates that have the observable,
+        # the gradient or a gate which is not unitary later on their wires
+        wires = set(GateUtil.get_ys(self.observable))
+        result = set()
+        xs = sorted(set(g.get_location().x for g in self.gates), reverse=True)
+        layers = {}
+        for gate in self.gates:
+            layers.setdefault(gate.get_location().x, []).append(gate)
+        for x in xs:
+            kept = []
+            for gate in layers[x]:
+                ys = GateUtil.get_ys(gate)
+                if gate.type != Type.UNITARY or gate.group_id == grad_id or not wires.isdisjoint(ys):
+                    kept.append(gate)
+            for gate in kept:
+                result.add(id(gate))
+                wires.update(GateUtil.get_ys(gate))
+        return result
+
+    def to_grad_var(self, grad_id, mhalf, light_cone=True) -> TensorNetworks:
+        cone = self.light_cone(grad_id) if light_cone else None
         result = TensorNetworks()
         net1 = TensorNetwork(mhalf, self.b_height * 2 + 1, self.observable.get_location().x * 2 + 1)
-        self._do_add_grad_avg(net1, grad_id)
-        self._do_add_grad_avg(net1, grad_id, y_offset=self.b_height + 1)
+        self._do_add_grad_avg(net1, grad_id, cone=cone)
+        self._do_add_grad_avg(net1, grad_id, y_offset=self.b_height + 1, cone=cone)
         result.add(Coefficient(-1, [Factor.HIST_A]), net1)
         net2 = TensorNetwork(mhalf, self.b_height * 2 + 1, self.observable.get_location().x * 2 + 1)
-        self._do_add_grad_avg(net2, grad_id)
-        self._do_add_grad_avg(net2, grad_id, dagger=True, y_offset=self.b_height + 1)
+        self._do_add_grad_avg(net2, grad_id, cone=cone)
+        self._do_add_grad_avg(net2, grad_id, dagger=True, y_offset=self.b_height + 1, cone=cone)
         result.add(Coefficient(2, [Factor.HIST_B]), net2)
         net3 = TensorNetwork(mhalf, self.b_height * 2 + 1, self.observable.get_location().x * 2 + 1)
-        self._do_add_grad_avg(net3, grad_id, dagger=True)
-        self._do_add_grad_avg(net3, grad_id, dagger=True, y_offset=self.b_height + 1)
+        self._do_add_grad_avg(net3, grad_id, dagger=True, cone=cone)
+        self._do_add_grad_avg(net3, grad_id, dagger=True, y_offset=self.b_height + 1, cone=cone)
         result.add(Coefficient(-1, [Factor.HIST_C]), net3)
         for network in result.networks:
             network.transpile()
         return result
 
-    def to_grad_avg(self, grad_id, mhalf) -> TensorNetworks:
+    def to_grad_avg(self, grad_id, mhalf, light_cone=True) -> TensorNetworks:
+        cone = self.light_cone(grad_id) if light_cone else None
         result = TensorNetworks()
         net1 = TensorNetwork(mhalf, self.b_height, self.observable.get_location().x * 2 + 1)
-        self._do_add_grad_avg(net1, grad_id)
+        self._do_add_grad_avg(net1, grad_id, cone=cone)
         result.add(Coefficient(-1j, []), net1)
         net2 = TensorNetwork(mhalf, self.b_height, self.observable.get_location().x * 2 + 1)
-        self._do_add_grad_avg(net2, grad_id, dagger=True)
+        self._do_add_grad_avg(net2, grad_id, dagger=True, cone=cone)
         result.add(Coefficient(1j, []), net2)
         for network in result.networks:
             network.transpile()
         return result
 
-    def _do_add_grad_avg(self, result: TensorNetwork, grad_id, dagger=False, y_offset=0):
+    def _do_add_grad_avg(self, result: TensorNetwork, grad_id, dagger=False, y_offset=0, cone=None):
+        # the gates out of the light cone are not added, since they are cancelled by TensorNetwork.reduce
         for gate in self.gates:
+            if cone is not None and id(gate) not in cone:
+                continue
             loc = Location(gate.get_location().x,
                            y_offset + gate.get_location().y_start,
                            y_offset + gate.get_location().y_end)
@@ -126,6 +151,8 @@ class Circuit:
         result.add_node(o)
         offset = self.observable.get_location().x * 2
         for gate in reversed(self.gates):
+            if cone is not None and id(gate) not in cone:
+                continue
             loc = Location(offset - gate.get_location().x,
                            y_offset + gate.get_location().y_start,
                            y_offset + gate.get_location().y_end)
@@ -0,0 +1,140 @@
+from tn.core import *
+from array import array
+
+LEFT = 0
+RIGHT = 1
+NO_PLUG = -1
+
+
+class CompactTensorNetwork:
+    # integer indexed representation of TensorNetwork.
+    # gates and plugs are indices into flat buffers, plugs of a gate are stored contiguously
+    # (left plugs first, then right plugs) and an edge is a pair of partner indices.
+    def __init__(self, mhalf, b_height, depth):
+        self.mhalf = mhalf
+        self.b_height = b_height
+        self.depth = depth
+        self.group_ids = []
+        self._group_index = {}
+        # gate -> attributes
+        self.gate_x = array("i")
+        self.gate_y_start = array("i")
+        self.gate_y_end = array("i")
+        self.gate_type = array("b")
+        self.gate_dagger = array("b")
+        self.gate_group = array("i")
+        self.gate_alive = array("b")
+        self.gate_plug_start = array("i")
+        self.gate_n_left = array("i")
+        self.gate_n_right = array("i")
+        # plug -> attributes
+        self.plug_gate = array("i")
+        self.plug_j = array("i")
+        self.plug_direction = array("b")
+        self.plug_partner = array("i")
+
+    @classmethod
+    def from_network(cls, network: TensorNetwork):
+        result = CompactTensorNetwork(network.mhalf, network.b_height, network.depth)
+        plug_index = {}
+        for gate in network.nodes():
+            g = result.add_gate(gate.get_location(), gate.group_id, gate.type, gate.dagger,
+                                len(gate.get_left_plugs()), len(gate.get_right_plugs()))
+            start = result.gate_plug_start[g]
+            for i, plug in enumerate(gate.get_left_plugs() + gate.get_right_plugs()):
+                plug_index[id(plug)] = start + i
+        for edge in network.edge_map.values():
+            result.add_edge(plug_index[id(edge.left_plug)], plug_index[id(edge.right_plug)])
+        return result
+
+    def to_network(self):
+        result = TensorNetwork(self.mhalf, self.b_height, self.depth)
+        gates = {}
+        for g in range(len(self.gate_x)):
+            if not self.gate_alive[g]:
+                continue
+            gate = Gate(Location(self.gate_x[g], self.gate_y_start[g], self.gate_y_end[g]),
+                        self.group_ids[self.gate_group[g]], TYPES[self.gate_type[g]],
+                        dagger=bool(self.gate_dagger[g]))
+            result.add_node(gate)
+            gates[g] = gate
+        for p in range(len(self.plug_gate)):
+            q = self.plug_partner[p]
+            if self.plug_direction[p] != RIGHT or q == NO_PLUG:
+                continue
+            lp = gates[self.plug_gate[p]].get_plug(Direction.Right, self.plug_j[p])
+            rp = gates[self.plug_gate[q]].get_plug(Direction.Left, self.plug_j[q])
+            result.add_edge(lp, rp)
+        return result
+
+    def copy(self):
+        result = CompactTensorNetwork(self.mhalf, self.b_height, self.depth)
+        result.group_ids = self.group_ids.copy()
+        result._group_index = self._group_index.copy()
+        for name in ("gate_x", "gate_y_start", "gate_y_end", "gate_type", "gate_dagger", "gate_group",
+                     "gate_alive", "gate_plug_start", "gate_n_left", "gate_n_right",
+                     "plug_gate", "plug_j", "plug_direction", "plug_partner"):
+            setattr(result, name, array(getattr(self, name).typecode, getattr(self, name)))
+        return result
+
+    def add_gate(self, location: Location, group_id, t: Type, dagger, n_left, n_right):
+        if group_id not in self._group_index:
+            self._group_index[group_id] = len(self.group_ids)
+            self.group_ids.append(group_id)
+        g = len(self.gate_x)
+        self.gate_x.append(location.x)
+        self.gate_y_start.append(location.y_start)
+        self.gate_y_end.append(location.y_end)
+        self.gate_type.append(t.hash)
+        self.gate_dagger.append(1 if dagger else 0)
+        self.gate_group.append(self._group_index[group_id])
+        self.gate_alive.append(1)
+        self.gate_plug_start.append(len(self.plug_gate))
+        self.gate_n_left.append(n_left)
+        self.gate_n_right.append(n_right)
+        for direction, n in ((LEFT, n_left), (RIGHT, n_right)):
+            for i in range(n):
+                self.plug_gate.append(g)
+                self.plug_j.append(location.y_end - n + 1 + i)
+                self.plug_direction.append(direction)
+                self.plug_partner.append(NO_PLUG)
+        return g
+
+    def get_plug(self, g, direction, j):
+        start = self.gate_plug_start[g]
+        if direction == LEFT:
+            n = self.gate_n_left[g]
+        else:
+            start = start + self.gate_n_left[g]
+            n = self.gate_n_right[g]
+        i = j - (self.gate_y_end[g] - n + 1)
+        if i < 0 or i >= n:
+            return NO_PLUG
+        return start + i
+
+    def add_edge(self, lp, rp):
+        if self.plug_direction[lp] != RIGHT or self.plug_direction[rp] != LEFT:
+            raise InvalidVariableException("The directions of plugs are invalid.")
+        self.plug_partner[lp] = rp
+        self.plug_partner[rp] = lp
+
+    def remove_edge(self, p):
+        q = self.plug_partner[p]
+        if q == NO_PLUG:
+            return
+        self.plug_partner[p] = NO_PLUG
+        self.plug_partner[q] = NO_PLUG
+
+    def remove_gate(self, g):
+        start = self.gate_plug_start[g]
+        for p in range(start, start + self.gate_n_left[g] + self.gate_n_right[g]):
+            self.remove_edge(p)
+        self.gate_alive[g] = 0
+
+    def nbytes(self):
+        result = 0
+        for buffer in (self.gate_x, self.gate_y_start, self.gate_y_end, self.gate_type, self.gate_dagger,
+                       self.gate_group, self.gate_alive, self.gate_plug_start, self.gate_n_left,
+                       self.gate_n_right, self.plug_gate, self.plug_j, self.plug_direction, self.plug_partner):
+            result = result + buffer.itemsize * len(buffer)
+        return result
@@ -1,5 +1,12 @@
 from tn.core import *
+from tn.serialization import *
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+import hashlib
+import json
+import os
+import time
 
 
 class TNComputation(ABC):
@@ -8,7 +15,21 @@ class TNComputation(ABC):
         return networks
 
 
-class Multiply(TNComputation):
+class RewriteRule(ABC):
+    @abstractmethod
+    def anchor(self):
+        # (type, dagger) of the nodes where the rule is tried
+        pass
+
+    @abstractmethod
+    def rewrite(self, network: TensorNetwork, node: Gate):
+        # rewrites the network around the node, and returns the nodes which should be tried again,
+        # or None if the rule does not match
+        pass
+
+
+class MultiplyRule(RewriteRule):
+    # contracts a left node with the right node which takes all of its right plugs into the left node
     def __init__(self, type_left: Type, type_right: Type, left_dagger, right_dagger,
                  type_result: Type, result_dagger):
         self.type_left = type_left
@@ -18,70 +39,361 @@ class Multiply(TNComputation):
         self.type_result = type_result
         self.result_dagger = result_dagger
 
+    def anchor(self):
+        return self.type_left, self.left_dagger
+
+    def rewrite(self, network: TensorNetwork, node: Gate):
+        n2 = self._match(network, node)
+        if n2 is None:
+            return None
+        p_map = {}
+        for i, lp in enumerate(node.get_right_plugs()):
+            network.remove_edge(lp)
+            p_map[i] = lp
+        for i, p in enumerate(n2.get_right_plugs()):
+            rp = network.partner(p)
+            if rp is None:
+                continue
+            network.remove_edge(p)
+            network.add_edge(p_map[i], rp)
+        network.remove_simple(n2)
+        network.change_node(node, self.type_result, self.result_dagger)
+        # the left neighbours can match the result
+        return [node] + [g for g in (network.neighbour(p) for p in node.get_left_plugs()) if g is not None]
+
+    def _match(self, network: TensorNetwork, node: Gate):
+        # all the right plugs of the node are connected to the same node, which is connected only to the node
+        n2 = None
+        for p in node.get_right_plugs():
+            neighbour = network.neighbour(p)
+            if neighbour is None or (n2 is not None and n2 is not neighbour):
+                return None
+            n2 = neighbour
+        if n2 is None or n2.type != self.type_right or n2.dagger != self.right_dagger:
+            return None
+        if len(n2.get_left_plugs()) != len(node.get_right_plugs()):
+            return None
+        return n2
+
+
+class RewriteEngine(TNComputation):
+    # applies the rules to a fixpoint. the nodes are looked up in TensorNetwork.type_index instead of scanning the
+    # networks once per rule, and only the nodes around the rewrites are tried again
+    def __init__(self, rules):
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.anchor(), []).append(rule)
+
     def compute(self, networks: TensorNetworks):
-        for network in networks.networks:
-            self.do_compute(network)
-        return networks
+        result = TensorNetworks(merge=networks.merge)
+        for i, network in enumerate(networks.networks):
+            # the merged networks can become the same after the rewrites, so they are merged again
+            result.add(networks.coefficients[i], self.do_compute(network))
+        return result
 
     def do_compute(self, network: TensorNetwork):
-        pairs = []
-        for n in network.nodes():
-            n: Gate = n
-            if n.type != self.type_left or n.dagger != self.left_dagger:
+        worklist = deque()
+        queued = set()
+        for anchor in self.rules:
+            for node in network.nodes_of(*anchor):
+                worklist.append(node)
+                queued.add(id(node))
+        while len(worklist) > 0:
+            node = worklist.popleft()
+            queued.discard(id(node))
+            if network.node_map.get(node.id) is not node:
                 continue
-            n2 = None
-            for p in n.get_right_plugs():
-                node = network.node_map[p.edge.right_plug.node_id]
-                if n2 is not None and n2 != node:
-                    n2 = None
-                    break
-                if node.type != self.type_right or node.dagger != self.right_dagger:
-                    break
-                n2 = node
-            if n2 is not None:
-                pairs.append((n, n2))
-        for n, n2 in pairs:
-            p_map = {}
-            for i, lp in enumerate(n.get_right_plugs()):
-                network.remove_edge(lp)
-                p_map[i] = lp
-            for lp in n2.get_left_plugs():
-                network.remove_edge(lp)
-            for i, p in enumerate(n2.get_right_plugs()):
-                p: Plug = p
-                rp = p.edge.right_plug
-                network.remove_edge(p)
-                network.add_edge(p_map[i], rp)
-            network.remove_simple(n2)
-            network.change_node(n, self.type_result)
+            for rule in self.rules.get((node.type, node.dagger), []):
+                touched = rule.rewrite(network, node)
+                if touched is None:
+                    continue
+                for g in touched:
+                    if id(g) not in queued and (g.type, g.dagger) in self.rules:
+                        worklist.append(g)
+                        queued.add(id(g))
+                break
+        return network
+
+
+class Multiply(RewriteEngine):
+    # contracts the pairs to a fixpoint, so that U - U - O becomes O for U O -> O. the result takes result_dagger,
+    # and the right node must have as many left plugs as the right plugs of the left node
+    def __init__(self, type_left: Type, type_right: Type, left_dagger, right_dagger,
+                 type_result: Type, result_dagger):
+        super().__init__([MultiplyRule(type_left, type_right, left_dagger, right_dagger,
+                                       type_result, result_dagger)])
+
+
+class IntegrationObserver:
+    # receives the events of HaarIntegration. the times are time.perf_counter() values.
+    # the default does nothing, and the timers are skipped when enabled is False
+    enabled = False
+
+    def on_step(self, step, networks_in, networks_out, start, end):
+        pass
+
+    def on_integrate(self, step, g_id, branches, reductions, start, end):
+        pass
+
+    def on_timing(self, name, start, end):
+        pass
+
+
+class TraceCollector(IntegrationObserver):
+    # collects the events and exports them as a Chrome trace (chrome://tracing, Perfetto)
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+        self.totals = {}
+        self.counts = {}
+
+    def on_step(self, step, networks_in, networks_out, start, end):
+        self._add("step", "step", start, end, {"step": step, "networks_in": networks_in, "networks_out": networks_out})
+
+    def on_integrate(self, step, g_id, branches, reductions, start, end):
+        self._add("integrate", "integrate", start, end,
+                  {"step": step, "group": g_id, "branches": branches, "reductions": reductions})
+
+    def on_timing(self, name, start, end):
+        self._add(name, "timing", start, end, None)
+
+    def _add(self, name, category, start, end, args):
+        self.events.append((name, category, start, end, args))
+        self.totals[name] = self.totals.get(name, 0) + end - start
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def summary(self):
+        # name -> (count, total seconds)
+        return {name: (self.counts[name], self.totals[name]) for name in self.totals}
+
+    def to_chrome_trace(self):
+        origin = min((e[2] for e in self.events), default=0)
+        events = []
+        for name, category, start, end, args in self.events:
+            event = {"name": name, "cat": category, "ph": "X", "pid": 0, "tid": 0,
+                     "ts": (start - origin) * 1e6, "dur": (end - start) * 1e6}
+            if args is not None:
+                event["args"] = args
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+def _timed(observer: IntegrationObserver, name, f, *args):
+    if not observer.enabled:
+        return f(*args)
+    start = time.perf_counter()
+    result = f(*args)
+    observer.on_timing(name, start, time.perf_counter())
+    return result
 
 
 class HaarIntegration(TNComputation):
-    def __init__(self, n_steps):
-        self.two_haar = TwoHaarIntegration()
-        self.four_haar = FourHaarIntegration()
+    def __init__(self, n_steps, merge=False, workers=None, chunk_size=None, depth_first=False, cache_size=1024,
+                 observer: IntegrationObserver = None, prune=False, slack=0):
+        # the kernels of the local integrations are shared by all the integrators
+        self.cache = KernelCache(cache_size)
+        # the observer is not sent to the workers (see __getstate__), and their events are not collected
+        self.observer = observer if observer is not None else IntegrationObserver()
+        self.two_haar = TwoHaarIntegration(self.cache, self.observer)
+        self.four_haar = FourHaarIntegration(self.cache, self.observer)
         self.n_steps = n_steps
-
-    def compute(self, networks: TensorNetworks) -> TensorNetworks:
+        self.merge = merge
+        # if depth_first is True, compute collects the results of stream instead of running step by step
+        self.depth_first = depth_first
+        # if workers is set, the steps are taken here until there are a few chunks of networks for each worker,
+        # and then each chunk is sent to a process pool once and integrated to the end by stream.
+        # the networks are sent only once, since pickling them costs more than the steps themselves
+        self.workers = workers
+        self.chunk_size = chunk_size
+        # if prune is True, the branches whose leading power of D cannot reach the best one of the finished
+        # branches minus slack are discarded. the leading order of a sum of branches can be lower than
+        # the best branch when they cancel, which slack leaves room for.
+        # in the worker mode, each worker prunes with its own best and the pruned branches are not counted here
+        self.prune = prune
+        self.slack = slack
+        self.pruned = 0
+        self._best = None
+        self._step = 0
+
+    def compute(self, networks: TensorNetworks, checkpoint=None) -> TensorNetworks:
+        # if checkpoint (a file path) is set, the networks are saved after each step,
+        # and the computation resumes from the file if it was saved for the same input networks
+        self._step = 0
+        self.pruned = 0
+        self._best = None
+        if self.workers is not None and self.workers > 1:
+            if checkpoint is not None:
+                raise InvalidVariableException("checkpoint is not supported in the worker mode")
+            # the post processors would run in the workers, where their results are lost
+            if len(self.four_haar.post_processors) > 0:
+                raise InvalidVariableException("post processors are not supported in the worker mode")
+        if self.depth_first:
+            if checkpoint is not None:
+                raise InvalidVariableException("checkpoint is not supported in the depth first mode")
+            result = TensorNetworks(merge=self.merge)
+            for coeff, network in self.stream(networks):
+                result.add(coeff, network)
+            return result
         result = networks
-        for s in range(self.n_steps):
-            result = self.step(result)
+        start = 0
+        if checkpoint is not None:
+            source = self.source_key(networks)
+            resumed = self.load_checkpoint(checkpoint, source, self.n_steps)
+            if resumed is not None:
+                start, result = resumed
+                self._step = start
+        if self.workers is None or self.workers <= 1:
+            for s in range(start, self.n_steps):
+                result = self.step(result)
+                if checkpoint is not None:
+                    self.save_checkpoint(checkpoint, s + 1, source, result, self.n_steps)
+        else:
+            s = start
+            while s < self.n_steps and len(result.networks) < 4 * self.workers:
+                result = self.step(result)
+                s = s + 1
+            chunk_size = self._chunk_size(len(result.networks))
+            chunks = []
+            for i in range(0, len(result.networks), chunk_size):
+                chunks.append((s, result.coefficients[i:i + chunk_size], result.networks[i:i + chunk_size]))
+            result = TensorNetworks(merge=self.merge)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                # executor.map keeps the order of the chunks, so the result is deterministic
+                for data in executor.map(self.stream_chunk, chunks):
+                    partial = NetworksSerializer.loads(data)
+                    for i, network in enumerate(partial.networks):
+                        result.add(partial.coefficients[i], network)
         return result
 
+    def source_key(self, networks: TensorNetworks):
+        # the input networks and the settings which change the networks after each step
+        spec = [self.merge, self.n_steps, self.prune, self.slack if self.prune else 0]
+        for i, network in enumerate(networks.networks):
+            terms = [(c.digit, c.key(), c.histories) for c in networks.coefficients[i].coefficients()]
+            spec.append((terms, network.canonical()))
+        return hashlib.sha256(repr(spec).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def save_checkpoint(cls, path, step, source, networks: TensorNetworks, n_steps=-1):
+        # written to a temporary file first, so that a crash while writing keeps the previous checkpoint
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            with NetworksWriter(f, merge=networks.merge, step=step, source=source, n_steps=n_steps) as writer:
+                for i, network in enumerate(networks.networks):
+                    writer.write(networks.coefficients[i], network)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load_checkpoint(cls, path, source, n_steps):
+        # returns (the number of steps done, networks), or None if there is no checkpoint for the source
+        # and the number of steps
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                reader = NetworksReader(f)
+                if reader.source != source or reader.n_steps != n_steps or reader.step > n_steps:
+                    return None
+                return reader.step, reader.read_all()
+        except SerializationException:
+            return None
+
     def step(self, networks: TensorNetworks):
-        result = TensorNetworks()
+        if self.observer.enabled:
+            start = time.perf_counter()
+        result = TensorNetworks(merge=self.merge)
         for i, n in enumerate(networks.networks):
             coeff = networks.coefficients[i]
             network: TensorNetwork = n
             self.integrate_one(result, coeff, network)
+        if self.observer.enabled:
+            self.observer.on_step(self._step, len(networks.networks), len(result.networks),
+                                  start, time.perf_counter())
+        self._step = self._step + 1
         return result
 
-    def integrate_one(self, result: TensorNetworks, coeff: Coefficient, network: TensorNetwork):
-        network.reduce()
-        if len(network.group_map) == 0:
+    def stream(self, networks: TensorNetworks, start=0):
+        # integrates each network depth-first and yields the finished (coefficient, network) pairs,
+        # so that only the branches along the current path are kept in memory.
+        # the networks have been integrated for start steps
+        self._best = None
+        for i, n in enumerate(networks.networks):
+            stack = [(start, networks.coefficients[i], n)]
+            while len(stack) > 0:
+                s, coeff, network = stack.pop()
+                network.reduce()
+                if self.prune and self._prunable(coeff, network):
+                    continue
+                if s == self.n_steps or len(network.group_map) == 0:
+                    yield coeff, network
+                    continue
+                branches = TensorNetworks()
+                self._step = s
+                self.integrate_one(branches, coeff, network)
+                for j in reversed(range(len(branches.networks))):
+                    stack.append((s + 1, branches.coefficients[j], branches.networks[j]))
+
+    def stream_chunk(self, chunk):
+        # runs in the workers, and returns only the finished networks in the binary format,
+        # which is smaller and faster to load than the pickled objects
+        start, coefficients, networks = chunk
+        chunk_networks = TensorNetworks()
+        chunk_networks.coefficients = coefficients
+        chunk_networks.networks = networks
+        result = TensorNetworks(merge=self.merge)
+        for coeff, network in self.stream(chunk_networks, start):
+            result.add(coeff, network)
+        return NetworksSerializer.dumps(result)
+
+    def __getstate__(self):
+        # pickled for each chunk in the worker mode. the observer and its events stay in this process,
+        # and the workers observe nothing
+        state = self.__dict__.copy()
+        state["observer"] = IntegrationObserver()
+        state["post_processors"] = self.four_haar.post_processors
+        del state["two_haar"]
+        del state["four_haar"]
+        return state
+
+    def __setstate__(self, state):
+        post_processors = state.pop("post_processors")
+        self.__dict__.update(state)
+        self.two_haar = TwoHaarIntegration(self.cache, self.observer)
+        self.four_haar = FourHaarIntegration(self.cache, self.observer)
+        self.four_haar.post_processors = post_processors
+
+    def _chunk_size(self, n_networks):
+        if self.chunk_size is not None:
+            return self.chunk_size
+        # a few chunks per worker to balance the load
+        return max(1, math.ceil(n_networks / (4 * self.workers)))
+
+    def integrate_one(self, result: TensorNetworks, coeff: Coefficient, network: TensorNetwork,
+                      g_id=None, excludes=()):
+        # integrates the group g_id (the largest group by default), the groups in excludes are not reduced
+        if self.observer.enabled:
+            start = time.perf_counter()
+            n_out = len(result.networks)
+        n_nodes = len(network.node_map)
+        self._timed("reduce", network.reduce, excludes)
+        reductions = (n_nodes - len(network.node_map)) // 2
+        if self.prune and self._prunable(coeff, network):
+            return
+        if g_id is None:
+            if len(network.group_map) == 0:
+                result.add(coeff, network)
+                return
+            g_id, gates = sorted(network.group_map.items(), reverse=True)[0]
+        elif g_id not in network.group_map:
             result.add(coeff, network)
             return
-        g_id, gates = sorted(network.group_map.items(), reverse=True)[0]
+        else:
+            gates = network.group_map[g_id]
         if gates[0].type != Type.UNITARY:
             result.add(coeff, network)
             return
@@ -89,17 +401,163 @@ class HaarIntegration(TNComputation):
             coefficient = coeff.copy()
             factors, network = self.two_haar.integrate(network, g_id)
             coefficient.extend(factors)
-            result.add(coefficient, network)
+            self._add(result, coefficient, network, excludes)
         elif len(gates) == 4:
             pairs = self.four_haar.integrate(network, g_id)
             for factors, network in pairs:
                 coefficient = coeff.copy()
                 coefficient.extend(factors)
-                result.add(coefficient, network)
+                self._add(result, coefficient, network, excludes)
+        if self.observer.enabled:
+            # the branches merged into the existing entries are not counted
+            self.observer.on_integrate(self._step, g_id, len(result.networks) - n_out, reductions,
+                                       start, time.perf_counter())
         return
 
+    def _add(self, result: TensorNetworks, coeff: Coefficient, network: TensorNetwork, excludes=()):
+        if self.merge:
+            # reduce before insertion so that the branches that differ only by U U† pairs are merged
+            self._timed("reduce", network.reduce, excludes)
+        result.add(coeff, network)
+
+    def _timed(self, name, f, *args):
+        return _timed(self.observer, name, f, *args)
+
+    def _prunable(self, coeff, network: TensorNetwork):
+        # the networks without unitaries are finished and update the best leading order
+        bound = self.upper_bound(coeff, network)
+        if bound is None:
+            self.pruned = self.pruned + 1
+            return True
+        if self._best is not None and bound < self._best - self.slack:
+            self.pruned = self.pruned + 1
+            return True
+        if all(gates[0].type != Type.UNITARY for gates in network.group_map.values()):
+            if self._best is None or bound > self._best:
+                self._best = bound
+        return False
+
+    @classmethod
+    def upper_bound(cls, coeff, network: TensorNetwork):
+        # upper bound of the leading power of D (CoefficientReduced.approximate_d_count) of the branches.
+        # a group of 2 gates gives D^-1 and at most D^2 for each wire, and a group of 4 gates
+        # gives D^-2 (G) or D^-4 (G2) and at most D^4 for each wire
+        bound = None
+        for c in coeff.coefficients():
+            if c.digit != 0:
+                d = c.d_count - 2 * c.g_count - 4 * c.g2_count
+                bound = d if bound is None else max(bound, d)
+        if bound is None:
+            return None
+        for gates in network.group_map.values():
+            if gates[0].type != Type.UNITARY:
+                continue
+            n_wires = len(gates[0].get_left_plugs())
+            if len(gates) == 2:
+                bound = bound + n_wires
+            else:
+                bound = bound + 2 * n_wires
+        return bound
+
+
+class BatchedHaarIntegration:
+    # computes the networks of the gradients of all the groups in a circuit.
+    # the groups are integrated from the largest one as in HaarIntegration, so the integration of the groups
+    # larger than the group of the gradient is shared: the networks with all the gates unitary are integrated
+    # group by group, and the networks of each gradient are forked just before its group is integrated.
+    def __init__(self, integration: HaarIntegration, kind="var"):
+        if kind not in ("var", "avg"):
+            raise InvalidVariableException("kind should be var or avg")
+        self.integration = integration
+        self.kind = kind
+
+    def compute(self, circuit, mhalf):
+        groups = sorted(set(g.group_id for g in circuit.gates if g.type == Type.UNITARY), reverse=True)
+        # the shared networks take one step for each group, where the networks of a single gradient can skip
+        # the groups which are reduced away. the results are the same only if all the groups are integrated
+        if self.integration.n_steps < len(groups):
+            raise InvalidVariableException("n_steps should be at least the number of the groups")
+        initial = self._networks(circuit, None, mhalf)
+        # the types of the gradient gates only depend on their positions, so they are taken for all the groups
+        # from one template where every group is the gradient
+        template = self._networks(circuit, _AllGroups(), mhalf)
+        types = []
+        for network in template.networks:
+            types.append({(g.get_location().x, g.get_location().y_start): g.type for g in network.nodes()})
+        # the networks are kept separately for each initial network, since the gradient gates differ among them
+        shared = []
+        for i, network in enumerate(initial.networks):
+            networks = TensorNetworks(merge=self.integration.merge)
+            networks.add(initial.coefficients[i], network)
+            shared.append(networks)
+        pending = set(groups)
+        results = {}
+        for g_id in groups:
+            pending.discard(g_id)
+            forked = TensorNetworks(merge=self.integration.merge)
+            for i, networks in enumerate(shared):
+                for j, network in enumerate(networks.networks):
+                    forked.add(networks.coefficients[j].copy(), self._fork(network, g_id, types[i]))
+            results[g_id] = self.integration.compute(forked)
+            for i, networks in enumerate(shared):
+                step = TensorNetworks(merge=self.integration.merge)
+                for j, network in enumerate(networks.networks):
+                    self.integration.integrate_one(step, networks.coefficients[j], network, g_id, pending)
+                shared[i] = step
+        return results
+
+    def _networks(self, circuit, grad_id, mhalf):
+        # the light cone depends on the gradient, so the shared networks keep all the gates
+        if self.kind == "var":
+            return circuit.to_grad_var(grad_id, mhalf, light_cone=False)
+        return circuit.to_grad_avg(grad_id, mhalf, light_cone=False)
+
+    @classmethod
+    def _fork(cls, network: TensorNetwork, g_id, types):
+        result = network.copy()
+        for gate in list(result.group_map.get(g_id, [])):
+            result.change_node(gate, types[(gate.get_location().x, gate.get_location().y_start)])
+        result.group_map.pop(g_id, None)
+        return result
+
+
+class _AllGroups:
+    # the group id of the gradient which matches all the groups in Circuit.to_grad_var / to_grad_avg
+    def __eq__(self, o):
+        return True
+
+    __hash__ = None
+
+
+class KernelCache:
+    # LRU cache of the local integration kernels keyed on the signature of the connections around the group
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, signature, compute):
+        if signature in self._entries:
+            self.hits = self.hits + 1
+            self._entries.move_to_end(signature)
+            return self._entries[signature]
+        self.misses = self.misses + 1
+        value = compute(signature)
+        self._entries[signature] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
 
 class TwoHaarIntegration:
+    def __init__(self, cache=None, observer: IntegrationObserver = None):
+        self.cache = cache if cache is not None else KernelCache()
+        self.observer = observer if observer is not None else IntegrationObserver()
+
     def integrate(self, network: TensorNetwork, g_id):
         u, udagger = network.group_map[g_id]
         ys = GateUtil.get_ys(u)
@@ -110,48 +568,49 @@ class TwoHaarIntegration:
             ld = udagger.get_plug(Direction.Left, y)
             rd = udagger.get_plug(Direction.Right, y)
             factor = self.do_integrate(network, l, r, ld, rd)
-            factors.append(factor)
+            factors.extend(factor)
         network.remove_simple(u)
         network.remove_simple(udagger)
         return factors, network
 
     def do_integrate(self, network: TensorNetwork, l, r, ld, rd):
-        lp = l.edge.left_plug
-        rp = r.edge.right_plug
-        ldp = ld.edge.left_plug
-        rdp = rd.edge.right_plug
-        network.remove_edge(l)
-        network.remove_edge(r)
-        network.remove_edge(ld)
-        network.remove_edge(rd)
-        if PlugUtil.connected(l, rd) and PlugUtil.connected(r, ld):
-            factor = [Factor.D]
-        elif PlugUtil.connected(l, rd):
-            network.add_edge(lp, rp)
-            factor = []
-        elif PlugUtil.connected(r, ld):
-            network.add_edge(lp, rdp)
-            factor = []
-        else:
-            network.add_edge(ldp, rp)
-            network.add_edge(lp, rdp)
-            factor = [Factor.DF]
-        return factor
+        # pairs that becomes delta when integrated, with the weight 1/D
+        haar_pairs = [(l, rd), (ld, r)]
+        signature = _timed(self.observer, "path", PathUtil.signature, haar_pairs, network)
+        slots, factors = self.cache.get(signature, self._kernel)
+        _timed(self.observer, "rewire", PathUtil.rewire, network, haar_pairs, slots)
+        return list(factors)
+
+    @classmethod
+    def _kernel(cls, signature):
+        slots, n_loop = PathUtil.find_outside_slots(signature)
+        return slots, (Factor.DF,) + PathUtil.loop_factors(n_loop)
 
 
 class FourHaarIntegration:
-    def __init__(self):
-        self.integrators = [ParallelIntegrator(), ParallelIntegrator(True), CrossIntegrator(), CrossIntegrator(True)]
+    def __init__(self, cache=None, observer: IntegrationObserver = None):
+        cache = cache if cache is not None else KernelCache()
+        self.observer = observer if observer is not None else IntegrationObserver()
+        self.integrators = [ParallelIntegrator(cache=cache, observer=observer),
+                            ParallelIntegrator(True, cache, observer),
+                            CrossIntegrator(cache=cache, observer=observer),
+                            CrossIntegrator(True, cache, observer)]
         self.post_processors = []
 
     def integrate(self, network: TensorNetwork, g_id):
         results = []
         hists = [Factor.HIST1, Factor.HIST2, Factor.HIST3, Factor.HIST4]
+        # the branches share the network as overlays while they are integrated. all the overlays are registered
+        # before any of them is materialized, since the last one to be materialized takes the network itself.
+        # the other three are materialized by TensorNetwork.copy, which is linear in the size of the network
+        # rather than the size of the group
+        overlays = [network.overlay() for _ in self.integrators]
         for index, integrator in enumerate(self.integrators):
-            net = network.copy()
-            factor, net = integrator.integrate(net, g_id)
+            factor, net = integrator.integrate(overlays[index], g_id)
             factor.append(hists[index])
             results.append((factor, net))
+        results = [(factor, _timed(self.observer, "copy", net.materialize)) for factor, net in results]
+        for factor, net in results:
             for post_process in self.post_processors:
                 post_process.run(net)
         return results
@@ -165,13 +624,16 @@ class PostProcess(ABC):
 
 class DrawNetwork(PostProcess):
     def run(self, network):
+        import matplotlib.pyplot as plt
         network.draw()
         plt.show()
 
 
 class Integrator(ABC):
-    def __init__(self, swap=False):
+    def __init__(self, swap=False, cache=None, observer: IntegrationObserver = None):
         self.swap = swap
+        self.cache = cache if cache is not None else KernelCache()
+        self.observer = observer if observer is not None else IntegrationObserver()
 
     def integrate(self, network: TensorNetwork, g_id):
         u1, udagger1, u2, udagger2 = network.group_map[g_id]
@@ -208,20 +670,16 @@ class Integrator(ABC):
                      r2: Plug, r2d: Plug):
         # pairs that becomes delta when integrated
         haar_pairs = self.get_haar_pairs(l1, l1d, r1, r1d, l2, l2d, r2, r2d)
-        # pairs that connects after haar integration
-        final_pairs, n_loop = PathUtil.find_outside_pairs(haar_pairs)
-        map = {1: Factor.D, 2: Factor.D2, 3: Factor.D3, 4: Factor.D4}
-        factors = []
-        if n_loop > 0:
-            factors.append(map[n_loop])
-        # remove edges in all plugs in integrated unitaries
-        for p in haar_pairs:
-            network.remove_edge(p[0])
-            network.remove_edge(p[1])
-        # connect edge between outside pairs
-        for p in final_pairs:
-            network.add_edge(p[0], p[1])
-        return factors
+        # the same connections around the group always give the same rewiring and factors
+        signature = _timed(self.observer, "path", PathUtil.signature, haar_pairs, network)
+        slots, factors = self.cache.get(signature, self._kernel)
+        _timed(self.observer, "rewire", PathUtil.rewire, network, haar_pairs, slots)
+        return list(factors)
+
+    @classmethod
+    def _kernel(cls, signature):
+        slots, n_loop = PathUtil.find_outside_slots(signature)
+        return slots, PathUtil.loop_factors(n_loop)
 
     @abstractmethod
     def get_haar_pairs(self, l1: Plug, l1d: Plug, r1: Plug, r1d: Plug, l2: Plug, l2d: Plug, r2: Plug, r2d: Plug):
@@ -234,78 +692,86 @@ class Integrator(ABC):
 
 class PathUtil:
     @classmethod
-    def find_outside_pairs(cls, haar_pairs):
-        # path that is already connected
-        pairs = cls.find_pairs(haar_pairs)
-        left_plugs = []
-        for p in haar_pairs:
-            if not cls._included(p[0], pairs):
-                left_plugs.append(p[0])
+    def find_outside_pairs(cls, haar_pairs, network=None):
+        partner = PlugUtil.partner if network is None else network.partner
+        slots, n_loop = cls.find_outside_slots(cls.signature(haar_pairs, network))
         final_pairs = []
-        paths = []
-        for left_p in left_plugs:
-            left_p: Plug = left_p
-            path = cls._add_path([left_p], left_p, pairs.copy(), haar_pairs.copy())
-            paths.append(path)
-            final_pairs.append((left_p.edge.left_plug, path[len(path) - 1].edge.right_plug))
-        n_loop = 0
-        for pair in pairs:
-            path = cls._add_path([pair[0]], pair[0], pairs.copy(), haar_pairs.copy())
-            if cls.contains(paths, path):
-                continue
-            paths.append(path)
-            n_loop = n_loop + 1
+        for i, j in slots:
+            final_pairs.append((partner(haar_pairs[i][0]), partner(haar_pairs[j][1])))
         return final_pairs, n_loop
 
     @classmethod
-    def contains(cls, paths, path):
-        for path2 in paths:
-            path_set = set(path2)
-            for p in path:
-                if p in path_set:
-                    return True
-        return False
+    def signature(cls, haar_pairs, network=None):
+        # for each haar pair, the haar pair whose left plug is connected to its right plug, or -1
+        # if the right plug is connected to the outside
+        partner = PlugUtil.partner if network is None else network.partner
+        slots = {}
+        for i, p in enumerate(haar_pairs):
+            slots[id(p[0])] = i
+        result = []
+        for p in haar_pairs:
+            plug = partner(p[1])
+            result.append(slots.get(id(plug), -1) if plug is not None else -1)
+        return tuple(result)
 
     @classmethod
-    def _add_path(cls, path, plug: Plug, pairs, haar_pairs):
-        for i, p in enumerate(haar_pairs):
-            if p[0] == plug:
-                path.append(p[1])
-                haar_pairs.pop(i)
-                return cls._add_path(path, p[1], pairs, haar_pairs)
-            elif p[1] == plug:
-                path.append(p[0])
-                haar_pairs.pop(i)
-                return cls._add_path(path, p[0], pairs, haar_pairs)
-        for i, p in enumerate(pairs):
-            if p[0] == plug:
-                if path.__contains__(p[1]):
-                    return path
-                pairs.pop(i)
-                path.append(p[1])
-                return cls._add_path(path, p[1], pairs, haar_pairs)
-            if p[1] == plug:
-                if path.__contains__(p[0]):
-                    return path
-                pairs.pop(i)
-                path.append(p[0])
-                return cls._add_path(path, p[0], pairs, haar_pairs)
-        return path
+    def find_outside_slots(cls, signature):
+        # haar pairs and the edges between them (paths that are already connected) form open paths,
+        # whose ends are connected to the outside, and loops.
+        # returns the (start, end) haar pairs of the open paths and the number of loops
+        linked = set(i for i in signature if i >= 0)
+        visited = set()
+        slots = []
+        # every open path starts from a left plug which is connected to the outside
+        for i in range(len(signature)):
+            if i in linked:
+                continue
+            j = i
+            while True:
+                visited.add(j)
+                if signature[j] < 0:
+                    break
+                j = signature[j]
+            slots.append((i, j))
+        n_loop = 0
+        for i in range(len(signature)):
+            if i in visited:
+                continue
+            n_loop = n_loop + 1
+            j = i
+            while j not in visited:
+                visited.add(j)
+                j = signature[j]
+        return tuple(slots), n_loop
 
     @classmethod
-    def _included(cls, plug: Plug, pairs):
-        for pair in pairs:
-            if plug == pair[0] or plug == pair[1]:
-                return True
-        return False
+    def loop_factors(cls, n_loop):
+        map = {1: Factor.D, 2: Factor.D2, 3: Factor.D3, 4: Factor.D4}
+        if n_loop > 0:
+            return (map[n_loop],)
+        return ()
 
     @classmethod
-    def find_pairs(cls, haar_pairs):
-        pairs = []
+    def rewire(cls, network, haar_pairs, slots):
+        # pairs that connects after haar integration
+        final_pairs = []
+        for i, j in slots:
+            final_pairs.append((network.partner(haar_pairs[i][0]), network.partner(haar_pairs[j][1])))
+        # remove edges in all plugs in integrated unitaries
         for p in haar_pairs:
-            for p2 in haar_pairs:
-                if PlugUtil.connected(p2[1], p[0]):
-                    pairs.append((p[0], p2[1]))
+            network.remove_edge(p[0])
+            network.remove_edge(p[1])
+        # connect edge between outside pairs
+        for p in final_pairs:
+            network.add_edge(p[0], p[1])
+
+    @classmethod
+    def find_pairs(cls, haar_pairs, network=None):
+        signature = cls.signature(haar_pairs, network)
+        pairs = []
+        for i, j in enumerate(signature):
+            if j >= 0:
+                pairs.append((haar_pairs[j][0], haar_pairs[i][1]))
         return pairs
 
 
@@ -1,9 +1,7 @@
-import networkx as nx
 import math
 import enum
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-import random
+import itertools
+import heapq
 
 
 class Edge:
@@ -15,18 +13,22 @@ class Edge:
         right_plug.edge = self
         self.left_plug: Plug = left_plug
         self.right_plug: Plug = right_plug
-        self.id = self.__hash__()
+        self.id = next(_edge_ids)
+
+    def __setstate__(self, state):
+        # the ids are only unique in a process, the edges from the other processes get new ones
+        self.__dict__.update(state)
+        self.id = next(_edge_ids)
 
     def __hash__(self) -> int:
         if self.left_plug is None or self.right_plug is None:
             return 0
-        return 31 + 13 * self.left_plug.__hash__() \
-               + 17 * self.right_plug.__hash__()
+        return hash((self.left_plug, self.right_plug))
 
     def __eq__(self, o: object) -> bool:
         if type(o) is not Edge:
             return False
-        return self.__hash__() == o.__hash__()
+        return self.left_plug == o.left_plug and self.right_plug == o.right_plug
 
     def detach(self):
         self.left_plug.edge = None
@@ -58,6 +60,10 @@ class Factor(enum.Enum):
         self.id = id
         self.d_count = d_count
 
+    def is_history(self):
+        return self in (Factor.HIST1, Factor.HIST2, Factor.HIST3, Factor.HIST4,
+                        Factor.HIST_A, Factor.HIST_B, Factor.HIST_C)
+
 
 class Direction(enum.Enum):
     Left = ("left", 23)
@@ -77,41 +83,247 @@ class Direction(enum.Enum):
 
 
 class Coefficient:
+    # digit x D^d_count / (D^2-1)^g_count / (D^4-1)^g2_count, the factors are accumulated into the counters
     def __init__(self, digit, factors):
-        self.factors = factors
         self.digit = digit
+        self.d_count = 0
+        self.g_count = 0
+        self.g2_count = 0
+        # labels of the history factors
+        self.histories = ()
+        self.extend(factors)
 
     def add(self, factor):
-        self.factors.append(factor)
+        self.d_count = self.d_count + factor.d_count
+        if factor == Factor.MI:
+            self.digit = self.digit * -1
+        elif factor == Factor.G:
+            self.g_count = self.g_count + 1
+        elif factor == Factor.G2:
+            self.g2_count = self.g2_count + 1
+        elif factor.is_history():
+            self.histories = self.histories + (factor.label,)
 
     def multiply(self, v):
         self.digit = self.digit * v
 
     def extend(self, factors):
-        self.factors.extend(factors)
+        for f in factors:
+            self.add(f)
 
     def copy(self):
         result = Coefficient(self.digit, [])
-        for f in self.factors:
-            result.add(f)
+        result.d_count = self.d_count
+        result.g_count = self.g_count
+        result.g2_count = self.g2_count
+        result.histories = self.histories
+        return result
+
+    def canonical(self):
+        # drops the histories
+        result = self.copy()
+        result.histories = ()
+        return result
+
+    def key(self):
+        return self.d_count, self.g_count, self.g2_count
+
+    def is_appendable(self, c):
+        return self.key() == c.key()
+
+    def append(self, c):
+        if not self.is_appendable(c):
+            raise InvalidVariableException("not appendable")
+        self.histories = ()
+        self.digit = self.digit + c.digit
+
+    def coefficients(self):
+        return [self]
+
+    def to_rational(self):
+        return RationalFunction.from_counts(self.digit, self.d_count, self.g_count, self.g2_count)
+
+
+class RationalFunction:
+    # exact sum of the coefficients as a rational function of D:
+    # sum_k numerator[k] D^k / ((D^2-1)^g (D^2+1)^h), using D^4-1 = (D^2-1)(D^2+1)
+    def __init__(self, numerator=None, g=0, h=0):
+        self.numerator = {}
+        if numerator is not None:
+            for k, v in numerator.items():
+                if v != 0:
+                    self.numerator[k] = v
+        self.g = g
+        self.h = h
+
+    @classmethod
+    def from_counts(cls, digit, d_count, g_count, g2_count):
+        return RationalFunction({d_count: digit}, g_count + g2_count, g2_count)
+
+    def is_zero(self):
+        return len(self.numerator) == 0
+
+    def __add__(self, o):
+        if not isinstance(o, RationalFunction):
+            return NotImplemented
+        g = max(self.g, o.g)
+        h = max(self.h, o.h)
+        numerator = self._expand(g, h)
+        for k, v in o._expand(g, h).items():
+            numerator[k] = numerator.get(k, 0) + v
+        return RationalFunction(numerator, g, h).simplify()
+
+    def _expand(self, g, h):
+        # numerator over the denominator (D^2-1)^g (D^2+1)^h
+        numerator = dict(self.numerator)
+        for _ in range(g - self.g):
+            numerator = self._multiply(numerator, -1)
+        for _ in range(h - self.h):
+            numerator = self._multiply(numerator, 1)
+        return numerator
+
+    @classmethod
+    def _multiply(cls, numerator, sign):
+        # multiplies by D^2 + sign
+        result = {}
+        for k, v in numerator.items():
+            result[k + 2] = result.get(k + 2, 0) + v
+            result[k] = result.get(k, 0) + sign * v
+        return result
+
+    @classmethod
+    def _divide(cls, numerator, sign):
+        # divides by D^2 + sign, returns None if it is not divisible
+        remainder = dict(numerator)
+        quotient = {}
+        lowest = min(remainder)
+        for k in range(max(remainder), lowest + 1, -1):
+            v = remainder.pop(k, 0)
+            if v != 0:
+                quotient[k - 2] = v
+                remainder[k - 2] = remainder.get(k - 2, 0) - sign * v
+        for v in remainder.values():
+            if v != 0:
+                return None
+        return quotient
+
+    def simplify(self):
+        if self.is_zero():
+            self.g = 0
+            self.h = 0
+            return self
+        for sign in (-1, 1):
+            while (self.g if sign == -1 else self.h) > 0:
+                quotient = self._divide(self.numerator, sign)
+                if quotient is None:
+                    break
+                self.numerator = {k: v for k, v in quotient.items() if v != 0}
+                if sign == -1:
+                    self.g = self.g - 1
+                else:
+                    self.h = self.h - 1
+        return self
+
+    def __eq__(self, o: object) -> bool:
+        if not isinstance(o, RationalFunction):
+            return False
+        g = max(self.g, o.g)
+        h = max(self.h, o.h)
+        left = {k: v for k, v in self._expand(g, h).items() if v != 0}
+        right = {k: v for k, v in o._expand(g, h).items() if v != 0}
+        return left == right
+
+    def __repr__(self):
+        if self.is_zero():
+            return "0"
+        terms = " + ".join("{} D^{}".format(v, k) for k, v in sorted(self.numerator.items(), reverse=True))
+        return "({})/((D^2-1)^{} (D^2+1)^{})".format(terms, self.g, self.h)
+
+
+class CoefficientSum:
+    # sum of the coefficients of the merged networks, one canonical term per power of D
+    def __init__(self):
+        self.terms = {}
+
+    def append(self, coeff):
+        for c in coeff.coefficients():
+            c = c.canonical()
+            key = c.key()
+            if key in self.terms:
+                self.terms[key].append(c)
+            else:
+                self.terms[key] = c
+
+    def extend(self, factors):
+        terms = {}
+        for c in self.terms.values():
+            c.extend(factors)
+            c = c.canonical()
+            terms[c.key()] = c
+        self.terms = terms
+
+    def multiply(self, v):
+        for c in self.terms.values():
+            c.multiply(v)
+
+    def copy(self):
+        result = CoefficientSum()
+        for key, c in self.terms.items():
+            result.terms[key] = c.copy()
         return result
 
+    def coefficients(self):
+        return list(self.terms.values())
+
+    def to_rational(self):
+        return sum((c.to_rational() for c in self.terms.values()), RationalFunction())
+
+
+# ids of the plugs, which are the nodes of the graph in TensorNetwork.draw
+_plug_ids = itertools.count()
+# ids of the edges, the keys of TensorNetwork.edge_map
+_edge_ids = itertools.count()
+# ids of the gates interned by Gate.key, the keys of TensorNetwork.node_map
+_gate_ids = {}
+_FINGERPRINT_MASK = (1 << 64) - 1
+
+
+def _mix(x):
+    # splitmix64. the prints are summed up, so they are mixed non-linearly, otherwise the networks whose edges
+    # differ by a permutation of the ends give the same sum
+    x = (x + 0x9E3779B97F4A7C15) & _FINGERPRINT_MASK
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _FINGERPRINT_MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _FINGERPRINT_MASK
+    return x ^ (x >> 31)
+
 
 class Plug:
-    def __init__(self, j, direction, node_id):
+    def __init__(self, j, direction, node_id, gate=None):
         self.j = j
         self.direction = direction
         self.edge = None
         self.node_id = node_id
-        self.id = random.randint(0, 10000000)
+        # the gate which owns the plug
+        self.gate = gate
+        self.id = next(_plug_ids)
+
+    def __getstate__(self):
+        # the owner is restored by Gate.__setstate__, which keeps the recursion of pickle shallow
+        state = self.__dict__.copy()
+        state["gate"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.id = next(_plug_ids)
 
     def __hash__(self) -> int:
-        return 13 * (self.j + 1) + 17 * self.node_id + self.direction.__hash__()
+        return hash((self.j, self.node_id, self.direction.hash))
 
     def __eq__(self, o: object) -> bool:
         if type(o) is not Plug:
             return False
-        return self.__hash__() == o.__hash__()
+        return self.j == o.j and self.node_id == o.node_id and self.direction == o.direction
 
 
 class Type(enum.Enum):
@@ -131,6 +343,9 @@ class Type(enum.Enum):
         return self.hash
 
 
+TYPES = {t.hash: t for t in Type}
+
+
 class Location:
     def __init__(self, x, y_start, y_end):
         self.x = x
@@ -144,12 +359,12 @@ class Location:
         return self.x + 1 / (self.y_start + 1)
 
     def __hash__(self) -> int:
-        return 13 * self.x + 17 * self.y_start + 31 * self.y_end
+        return hash((self.x, self.y_start, self.y_end))
 
     def __eq__(self, o: object) -> bool:
         if type(o) is not Location:
             return False
-        return self.__hash__() == o.__hash__()
+        return (self.x, self.y_start, self.y_end) == (o.x, o.y_start, o.y_end)
 
     def __repr__(self) -> str:
         return "({}, {}-{})".format(self.x, self.y_start, self.y_end)
@@ -176,6 +391,15 @@ class PlugUtil:
             return True
         return False
 
+    @classmethod
+    def partner(cls, plug):
+        # the plug on the other side of the edge
+        if plug.edge is None:
+            return None
+        if plug.direction == Direction.Left:
+            return plug.edge.left_plug
+        return plug.edge.right_plug
+
 
 class Gate:
     def __init__(self, location: Location, group_id, t: Type, dagger=False):
@@ -183,9 +407,30 @@ class Gate:
         self.group_id = group_id
         self.type = t
         self.dagger = dagger
-        self.id = self.__hash__()
+        self.id = self.intern(self.key())
         self.plugs = {Direction.Left: self._left_plugs(),
                       Direction.Right: self._right_plugs()}
+        self._plug_index = {}
+        for plugs in self.plugs.values():
+            for plug in plugs:
+                self._plug_index[(plug.direction, plug.j)] = plug
+
+    def __setstate__(self, state):
+        # the interned ids differ over the processes, so the id is interned again in this process
+        self.__dict__.update(state)
+        self.id = self.intern(self.key())
+        for plug in self._plug_index.values():
+            plug.gate = self
+            plug.node_id = self.id
+
+    @classmethod
+    def intern(cls, key):
+        # the same id for the same key, and different ids for different keys
+        result = _gate_ids.get(key)
+        if result is None:
+            result = len(_gate_ids)
+            _gate_ids[key] = result
+        return result
 
     def copy_to(self, loc):
         return Gate(loc, self.group_id, self.type, dagger=self.dagger)
@@ -203,43 +448,35 @@ class Gate:
         return self.plugs.get(Direction.Right)
 
     def get_plug(self, direction: Direction, j):
-        for plug in self.plugs[direction]:
-            if plug.j == j:
-                return plug
-        return None
+        return self._plug_index.get((direction, j))
 
     def conjugate(self):
-        c = self.copy_to(self._location.copy())
-        c.dagger = not c.dagger
-        return c
+        return Gate(self._location.copy(), self.group_id, self.type, dagger=not self.dagger)
 
     def get_connectable(self, plug):
-        for p in self.plugs[plug.direction.invert()]:
-            if p.j == plug.j:
-                return p
-        return None
+        return self._plug_index.get((plug.direction.invert(), plug.j))
 
     def _left_plugs(self):
         if self.type == Type.INITIAL and not self.dagger:
             return []
-        return [Plug(j, Direction.Left, self.id) for j in range(self._location.y_start, self._location.y_end + 1)]
+        return [Plug(j, Direction.Left, self.id, self) for j in range(self._location.y_start, self._location.y_end + 1)]
 
     def _right_plugs(self):
         if self.type == Type.INITIAL and self.dagger:
             return []
-        return [Plug(j, Direction.Right, self.id) for j in range(self._location.y_start, self._location.y_end + 1)]
+        return [Plug(j, Direction.Right, self.id, self) for j in range(self._location.y_start, self._location.y_end + 1)]
+
+    def key(self):
+        return (self._location.x, self._location.y_start, self._location.y_end,
+                self.type.hash, self.dagger, self.group_id)
 
     def __hash__(self) -> int:
-        dag = 0
-        if self.dagger:
-            dag = 1
-        return 13 * self._location.__hash__() + 17 * self.group_id.__hash__() \
-               + 37 * dag + 41 * self.type.__hash__()
+        return hash(self.id)
 
     def __eq__(self, o: object) -> bool:
         if type(o) is not Gate:
             return False
-        return self.__hash__() == o.__hash__()
+        return self.key() == o.key()
 
     def __repr__(self) -> str:
         dagger = ""
@@ -256,6 +493,51 @@ class TensorNetwork:
         self.node_map = {}
         self.group_map = {}
         self.edge_map = {}
+        # number of overlays that have not been materialized yet
+        self._overlays = 0
+        # sum of the hashes of the nodes and the edges, updated by the modifications in O(1)
+        self._fingerprint = 0
+        # (type, dagger) -> {id: node} in the order of the insertions, for the rewrite rules
+        self.type_index = {}
+
+    def __setstate__(self, state):
+        # the ids of the gates and the edges are given again in this process, so the maps are rebuilt
+        self.__dict__.update(state)
+        self.node_map = {g.id: g for g in self.node_map.values()}
+        self.edge_map = {e.id: e for e in self.edge_map.values()}
+        self.type_index = {}
+        for g in self.node_map.values():
+            self.type_index.setdefault((g.type, g.dagger), {})[g.id] = g
+        self._fingerprint = 0
+        for g in self.node_map.values():
+            self._fingerprint = (self._fingerprint + self._node_print(g)) & _FINGERPRINT_MASK
+        for e in self.edge_map.values():
+            self._fingerprint = (self._fingerprint + self._edge_print(e)) & _FINGERPRINT_MASK
+
+    @classmethod
+    def _node_print(cls, gate: Gate):
+        return _mix(gate.id * 0xD6E8FEB86659FD93)
+
+    @classmethod
+    def _edge_print(cls, edge: Edge):
+        # the fields are taken apart by the odd multipliers before mixing
+        return _mix((edge.left_plug.node_id * 0xA0761D6478BD642F + edge.left_plug.j * 0xE7037ED1A0B428DB
+                     + edge.right_plug.node_id * 0x8EBC6AF09C88C6E3 + edge.right_plug.j * 0x589965CC75374CC3)
+                    & _FINGERPRINT_MASK)
+
+    def overlay(self):
+        self._overlays = self._overlays + 1
+        return TensorNetworkOverlay(self)
+
+    def partner(self, plug: Plug):
+        return PlugUtil.partner(plug)
+
+    def neighbour(self, plug: Plug):
+        # the gate on the other side of the edge
+        p = PlugUtil.partner(plug)
+        if p is None:
+            return None
+        return p.gate
 
     def copy(self):
         result = TensorNetwork(self.mhalf, self.b_height, self.depth)
@@ -265,32 +547,31 @@ class TensorNetwork:
             edge: Edge = e
             lp_: Plug = edge.left_plug
             rp_: Plug = edge.right_plug
-            lg: Gate = result.node_map[lp_.node_id]
-            rg: Gate = result.node_map[rp_.node_id]
-            lp, rp = None, None
-            for p in lg.get_right_plugs():
-                if p.j == lp_.j:
-                    lp = p
-                    break
-            for p in rg.get_left_plugs():
-                if p.j == rp_.j:
-                    rp = p
+            lp = result.node_map[lp_.node_id].get_plug(Direction.Right, lp_.j)
+            rp = result.node_map[rp_.node_id].get_plug(Direction.Left, rp_.j)
             result.add_edge(lp, rp)
         return result
 
-    def change_node(self, node: Gate, t: Type):
-        self.node_map.pop(node.id)
+    def change_node(self, node: Gate, t: Type, dagger=None):
+        # the edges of the node are printed with its id, so they are printed again with the new one
+        edges = [p.edge for p in node.get_left_plugs() + node.get_right_plugs() if p.edge is not None]
+        printed = sum(self._edge_print(e) for e in edges)
+        if dagger is not None and dagger != node.dagger and Type.INITIAL in (node.type, t):
+            # the plugs of the initial state depend on the dagger
+            raise InvalidVariableException("The dagger of the initial state cannot be changed.")
+        self._pop_node(node)
         node.type = t
-        node.id = node.__hash__()
-        left_plugs = node.get_left_plugs()
-        right_plugs = node.get_right_plugs()
-        for p, p2 in zip(left_plugs, right_plugs):
+        if dagger is not None:
+            node.dagger = dagger
+        node.id = Gate.intern(node.key())
+        for p in node.get_left_plugs() + node.get_right_plugs():
             p.node_id = node.id
-            p2.node_id = node.id
-        self.node_map[node.id] = node
+        self._put_node(node)
+        printed = sum(self._edge_print(e) for e in edges) - printed
+        self._fingerprint = (self._fingerprint + printed) & _FINGERPRINT_MASK
 
     def add_node(self, gate: Gate):
-        self.node_map[gate.id] = gate
+        self._put_node(gate)
         if gate.type != Type.UNITARY:
             return
         if gate.group_id not in self.group_map:
@@ -299,39 +580,58 @@ class TensorNetwork:
 
     def add_edge(self, lp: Plug, rp: Plug):
         edge = Edge(lp, rp)
+        self._fingerprint = (self._fingerprint + self._edge_print(edge)) & _FINGERPRINT_MASK
         self.edge_map[edge.id] = edge
 
     def nodes(self):
         return self.node_map.values()
 
-    def reduce(self):
-        for node in self.nodes():
-            if node.type != Type.UNITARY or len(node.get_right_plugs()) == 0:
+    def reduce(self, excludes=()):
+        # worklist of the unitaries ordered as in node_map, so that the pairs are removed in the same order
+        # as a rescan from the head. only the left neighbours of a removed pair can become reducible.
+        # the groups in excludes are not reduced.
+        order = list(self.nodes())
+        positions = {}
+        worklist = []
+        for i, node in enumerate(order):
+            positions[id(node)] = i
+            if node.type == Type.UNITARY and node.group_id not in excludes:
+                worklist.append(i)
+        while len(worklist) > 0:
+            node = order[heapq.heappop(worklist)]
+            if self.node_map.get(node.id) is not node:
                 continue
-            n_id = None
-            add = True
-            for p in node.get_right_plugs():
-                if n_id is None:
-                    n_id = p.edge.right_plug.node_id
-                elif n_id != p.edge.right_plug.node_id:
-                    add = False
-                    break
-                if node.group_id != self.node_map[n_id].group_id:
-                    add = False
-                    break
-            if add:
-                self.remove(node, self.node_map[n_id])
-                self.reduce()
-                return
-        return
+            n = self._reducible(node)
+            if n is None:
+                continue
+            neighbours = [self.neighbour(p) for p in node.get_left_plugs()]
+            self.remove(node, n)
+            for g in neighbours:
+                if g is not None and g.type == Type.UNITARY and g.group_id not in excludes:
+                    heapq.heappush(worklist, positions[id(g)])
+
+    def _reducible(self, node: Gate):
+        # returns the gate that cancels the node, if all the right plugs are connected to it
+        if len(node.get_right_plugs()) == 0:
+            return None
+        n = None
+        for p in node.get_right_plugs():
+            neighbour = self.neighbour(p)
+            if neighbour is None or (n is not None and n is not neighbour):
+                return None
+            n = neighbour
+        if node.group_id != n.group_id:
+            return None
+        return n
 
     def remove_edge(self, plug: Plug):
         if plug.edge is not None:
+            self._fingerprint = (self._fingerprint - self._edge_print(plug.edge)) & _FINGERPRINT_MASK
             self.edge_map.pop(plug.edge.id)
             plug.edge.detach()
 
     def remove_simple(self, node: Gate):
-        self.node_map.pop(node.id)
+        self._pop_node(node)
         members = []
         if node.group_id not in self.group_map:
             return
@@ -366,8 +666,8 @@ class TensorNetwork:
         for j, lp in left_map.items():
             rp = right_map[j]
             self.add_edge(lp, rp)
-        self.node_map.pop(l_node.id)
-        self.node_map.pop(r_node.id)
+        self._pop_node(l_node)
+        self._pop_node(r_node)
         members = []
         group_id = l_node.group_id
         for n in self.group_map[group_id]:
@@ -379,20 +679,59 @@ class TensorNetwork:
         else:
             self.group_map[group_id] = members
 
+    def nodes_of(self, t: Type, dagger):
+        return list(self.type_index.get((t, dagger), {}).values())
+
+    def _put_node(self, node: Gate):
+        self._fingerprint = (self._fingerprint + self._node_print(node)) & _FINGERPRINT_MASK
+        self.node_map[node.id] = node
+        self.type_index.setdefault((node.type, node.dagger), {})[node.id] = node
+
+    def _pop_node(self, node: Gate):
+        self._fingerprint = (self._fingerprint - self._node_print(node)) & _FINGERPRINT_MASK
+        self.node_map.pop(node.id)
+        nodes = self.type_index[(node.type, node.dagger)]
+        nodes.pop(node.id)
+        if len(nodes) == 0:
+            self.type_index.pop((node.type, node.dagger))
+
+    def canonical(self):
+        # structural key of the network, which does not suffer from the collisions of __hash__
+        gates = sorted(g.key() for g in self.nodes())
+        edges = sorted((self.node_map[e.left_plug.node_id].key(), e.left_plug.j,
+                        self.node_map[e.right_plug.node_id].key(), e.right_plug.j)
+                       for e in self.edge_map.values())
+        return tuple(gates), tuple(edges)
+
     def transpile(self):
+        # sweeps the nodes in the order of x, keeping the right plugs that wait for a connection on each wire.
+        # the first node with a larger x that has a left plug on the wire takes all of them.
         nodes = sorted(self.nodes(), key=lambda n: n.get_location().x)
-        for n in nodes:
-            for plug in n.get_right_plugs():
-                for n2 in nodes:
-                    if n.get_location().x >= n2.get_location().x:
-                        continue
-                    right = n2.get_connectable(plug)
-                    if right is not None:
-                        edge = Edge(plug, right)
-                        self.edge_map[edge.id] = edge
-                        break
+        waiting = {}
+        connections = []
+        start = 0
+        while start < len(nodes):
+            x = nodes[start].get_location().x
+            end = start
+            while end < len(nodes) and nodes[end].get_location().x == x:
+                end = end + 1
+            for n in nodes[start:end]:
+                for right in n.get_left_plugs():
+                    for key, plug in waiting.pop(right.j, []):
+                        connections.append((key, plug, right))
+            for i in range(start, end):
+                for k, plug in enumerate(nodes[i].get_right_plugs()):
+                    waiting.setdefault(plug.j, []).append(((i, k), plug))
+            start = end
+        # add the edges in the order of the left plugs, as the nodes are scanned
+        for key, plug, right in sorted(connections, key=lambda c: c[0]):
+            self.add_edge(plug, right)
 
     def draw(self, grid_width=1, space=0.3, ax=None):
+        # the plotting libraries are imported here, since they are slow to import and only needed for drawing
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as patches
+        import networkx as nx
         if ax is None:
             fig, ax = plt.subplots()
         ax.set_xlim([-0.1, self.depth])
@@ -412,40 +751,126 @@ class TensorNetwork:
                 height=grid_width * (node.get_location().y_end - node.get_location().y_start + 0.9),
                 linewidth=1, edgecolor='black', facecolor='none')
             ax.add_patch(rect)
-            plt.text(node.get_location().x + 0.1, node.get_location().y_start + 0.5, str(node))
+            ax.text(node.get_location().x + 0.1, node.get_location().y_start + 0.5, str(node))
         for plug in right_plugs:
             if plug.edge is not None:
                 netx.add_edge(plug.id, plug.edge.right_plug.id)
         pos = nx.get_node_attributes(netx, 'pos')
-        nx.draw_networkx(netx, pos, node_size=10,
+        nx.draw_networkx(netx, pos, node_size=10, ax=ax,
                          with_labels=False, connectionstyle="arc3,rad=0.1")
 
     def __eq__(self, o: object) -> bool:
+        # the fingerprints can collide, so the structures are compared if they are the same
         if type(o) is not TensorNetwork:
             return False
-        return self.__hash__() == o.__hash__()
+        if self is o:
+            return True
+        if self._fingerprint != o._fingerprint or len(self.node_map) != len(o.node_map) \
+                or len(self.edge_map) != len(o.edge_map):
+            return False
+        return self.canonical() == o.canonical()
 
     def __hash__(self):
-        result = 0
-        for i, item in enumerate(sorted(self.node_map.items())):
-            k, gate = item
-            result = result + gate.__hash__()
-        for i, item in enumerate(sorted(self.edge_map.items())):
-            k, edge = item
-            result = result + edge.__hash__() * (i + 1)
-        return result
+        return self._fingerprint
+
+
+class TensorNetworkOverlay:
+    # copy-on-write view of a TensorNetwork which records the changes instead of copying the base.
+    # the base is copied when materialized, except for the last overlay which reuses the base itself.
+    def __init__(self, base: TensorNetwork):
+        self.base = base
+        self.partners = {}
+        self.operations = []
+        self._network = None
+
+    @property
+    def group_map(self):
+        return self.base.group_map
+
+    @property
+    def node_map(self):
+        return self.base.node_map
+
+    def partner(self, plug: Plug):
+        if id(plug) in self.partners:
+            return self.partners[id(plug)]
+        return PlugUtil.partner(plug)
+
+    def add_edge(self, lp: Plug, rp: Plug):
+        if lp.direction == Direction.Left or rp.direction == Direction.Right:
+            raise InvalidVariableException("The directions of plugs are invalid.")
+        self.partners[id(lp)] = rp
+        self.partners[id(rp)] = lp
+        self.operations.append((self._add_edge, lp, rp))
+
+    def remove_edge(self, plug: Plug):
+        p = self.partner(plug)
+        if p is None:
+            return
+        self.partners[id(plug)] = None
+        self.partners[id(p)] = None
+        self.operations.append((self._remove_edge, plug, None))
+
+    def remove_simple(self, node: Gate):
+        self.operations.append((self._remove_simple, node, None))
+
+    def materialize(self):
+        # the network is kept, so that the base is not changed again by the later calls
+        if self._network is not None:
+            return self._network
+        self.base._overlays = self.base._overlays - 1
+        if self.base._overlays == 0:
+            network = self.base
+        else:
+            network = self.base.copy()
+        for operation, a, b in self.operations:
+            operation(network, a, b)
+        self._network = network
+        return network
+
+    @classmethod
+    def _add_edge(cls, network: TensorNetwork, lp: Plug, rp: Plug):
+        network.add_edge(cls._plug(network, lp), cls._plug(network, rp))
+
+    @classmethod
+    def _remove_edge(cls, network: TensorNetwork, plug: Plug, _):
+        network.remove_edge(cls._plug(network, plug))
+
+    @classmethod
+    def _remove_simple(cls, network: TensorNetwork, node: Gate, _):
+        network.remove_simple(network.node_map[node.id])
+
+    @classmethod
+    def _plug(cls, network: TensorNetwork, plug: Plug):
+        return network.node_map[plug.node_id].get_plug(plug.direction, plug.j)
 
 
 class TensorNetworks:
-    def __init__(self):
+    def __init__(self, merge=False):
         self.coefficients = []
         self.networks = []
+        # if merge is True, the networks with the same structure are merged on insertion
+        # and their coefficients are summed up into a CoefficientSum
+        self.merge = merge
+        self._index = {}
 
     def add(self, coeff, network):
-        self.coefficients.append(coeff)
+        if not self.merge:
+            self.coefficients.append(coeff)
+            self.networks.append(network)
+            return
+        key = network.canonical()
+        if key in self._index:
+            self.coefficients[self._index[key]].append(coeff)
+            return
+        total = CoefficientSum()
+        total.append(coeff)
+        self._index[key] = len(self.networks)
+        self.coefficients.append(total)
         self.networks.append(network)
 
     def draw(self, figsize=(10, 10)):
+        import matplotlib.pyplot as plt
         fig = plt.figure(figsize=figsize)
         length = int(math.sqrt(len(self.coefficients))) + 1
         for i, coeff in enumerate(self.coefficients):
@@ -0,0 +1,94 @@
+from tn.core import *
+import math
+import numpy as np
+import numbers
+from fractions import Fraction
+
+
+class Evaluation:
+    # value = phase x 2^log2_abs for each m, which does not overflow for large m
+    def __init__(self, ms, log2_abs, phase):
+        self.ms = ms
+        self.log2_abs = log2_abs
+        self.phase = phase
+
+    def values(self):
+        return self.phase * np.exp2(self.log2_abs)
+
+    def log10_abs(self):
+        return self.log2_abs * np.log10(2)
+
+
+class NumericEvaluator:
+    # the sums smaller than this times the largest term are computed exactly
+    CANCELLATION = 2.0 ** -20
+
+    def __init__(self, ms):
+        self.ms = np.asarray(ms, dtype=float)
+
+    def evaluate(self, rational: RationalFunction):
+        if rational.is_zero():
+            return Evaluation(self.ms, np.full(len(self.ms), -np.inf), np.zeros(len(self.ms)))
+        ks = sorted(rational.numerator)
+        # the exact coefficients can be larger than the floats, so their logs and phases are taken one by one
+        log2_cs = np.array([self._log2_abs(rational.numerator[k]) for k in ks])
+        phases = np.array([self._phase(rational.numerator[k]) for k in ks])
+        # log2 of c_k D^k without the sign, summed in the scale of the largest term
+        exponents = log2_cs[:, None] + np.array(ks, dtype=float)[:, None] * self.ms[None, :]
+        scale = np.max(exponents, axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mantissa = np.sum(phases[:, None] * np.exp2(exponents - scale[None, :]), axis=0)
+            log2_abs = scale + np.log2(np.abs(mantissa)) - self._log2_denominator(rational)
+            phase = np.where(mantissa == 0, 0, mantissa / np.abs(mantissa))
+        if all(isinstance(c, numbers.Rational) for c in rational.numerator.values()):
+            # the terms cancel in the floats when the sum is much smaller than the largest term.
+            # D is an integer for an integer m, so the numerator is summed exactly instead
+            denominator = self._log2_denominator(rational)
+            for i, m in enumerate(self.ms):
+                if np.abs(mantissa[i]) < self.CANCELLATION and m == int(m):
+                    log2_abs[i], phase[i] = self._exact(rational, ks, int(m))
+                    log2_abs[i] = log2_abs[i] - denominator[i]
+        if not np.iscomplexobj(phase) or np.all(np.imag(phase) == 0):
+            phase = np.real(phase)
+        return Evaluation(self.ms, log2_abs, phase)
+
+    @classmethod
+    def _exact(cls, rational: RationalFunction, ks, m):
+        # log2 |sum_k c_k 2^(m k)| and its sign, with the lowest power taken out
+        numerator = 0
+        for k in ks:
+            c = rational.numerator[k]
+            if not isinstance(c, numbers.Integral):
+                # the fractions reduce by gcd on each step, which is slow for the integers
+                c = Fraction(c)
+            numerator = numerator + c * (1 << (m * (k - ks[0])))
+        if numerator == 0:
+            return -np.inf, 0
+        return cls._log2_abs(numerator) + m * ks[0], cls._phase(numerator)
+
+    @classmethod
+    def _log2_abs(cls, c):
+        if isinstance(c, numbers.Rational):
+            # math.log2 takes the ints of any size
+            return math.log2(abs(c.numerator)) - math.log2(c.denominator)
+        return math.log2(abs(c))
+
+    @classmethod
+    def _phase(cls, c):
+        if isinstance(c, numbers.Rational):
+            return 1 if c > 0 else -1
+        return c / abs(c)
+
+    def _log2_denominator(self, rational: RationalFunction):
+        # log2(D^2 -+ 1) = 2m + log2(1 -+ 2^(-2m))
+        inverse = np.exp2(-2 * self.ms)
+        with np.errstate(divide="ignore"):
+            return rational.g * (2 * self.ms + np.log1p(-inverse) / np.log(2)) \
+                   + rational.h * (2 * self.ms + np.log1p(inverse) / np.log(2))
+
+    def evaluate_map(self, merged_map):
+        # merged_map of ReportBuilder: network -> list of CoefficientReduced
+        result = {}
+        for network, coeffs in merged_map.items():
+            result[network] = self.evaluate(sum((c.to_rational() for c in coeffs), RationalFunction()))
+        return result
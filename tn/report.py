@@ -1,31 +1,13 @@
 from tn.core import *
-import os, matplotlib.pyplot as plt, shutil
+from concurrent.futures import ProcessPoolExecutor
+import os, hashlib
 
 
 class CoefficientInterpreter:
     @classmethod
     def interpret(cls, coefficient):
-        hist_map = {Factor.HIST1: 1, Factor.HIST2: 2, Factor.HIST3: 3, Factor.HIST4: 4,
-                    Factor.HIST_A: "a", Factor.HIST_B: "b", Factor.HIST_C: "c"}
-        histories = []
-        for f in coefficient.factors:
-            if f in hist_map:
-                histories.append(f.label)
-        factors = sorted(coefficient.factors, key=lambda f: f.id)
-        d_count = 0
-        g_count = 0
-        g2_count = 0
-        digit = coefficient.digit
-        for f in factors:
-            f: Factor = f
-            d_count = d_count + f.d_count
-            if f == Factor.G:
-                g_count = g_count + 1
-            elif f == Factor.G2:
-                g2_count = g2_count + 1
-            elif f == Factor.MI:
-                digit = digit * -1
-        return CoefficientReduced(digit, d_count, g_count, g2_count, histories)
+        return CoefficientReduced(coefficient.digit, coefficient.d_count, coefficient.g_count,
+                                  coefficient.g2_count, list(coefficient.histories))
 
 
 class CoefficientReduced:
@@ -36,6 +18,9 @@ class CoefficientReduced:
         self.g2_count = g2_count
         self.histories = histories
 
+    def key(self):
+        return self.d_count, self.g_count, self.g2_count
+
     def approximate_d_count(self):
         if self.digit == 0:
             return 0
@@ -43,7 +28,7 @@ class CoefficientReduced:
 
     def is_appendable(self, d):
         d: CoefficientReduced = d
-        return self.d_count == d.d_count and self.g_count == d.g_count
+        return self.key() == d.key()
 
     def append(self, d):
         if not self.is_appendable(d):
@@ -54,6 +39,9 @@ class CoefficientReduced:
     def copy(self):
         return CoefficientReduced(self.digit, self.d_count, self.g_count, self.g2_count, self.histories)
 
+    def to_rational(self):
+        return RationalFunction.from_counts(self.digit, self.d_count, self.g_count, self.g2_count)
+
     def __repr__(self):
         return "{} x 2^({}m)/(2^(2m)-1)^{} (2^(4m)-1)^{}".format(self.digit, self.d_count,
                                                                  self.g_count, self.g2_count)
@@ -62,17 +50,16 @@ class CoefficientReduced:
 class CoefficientMerger:
     @classmethod
     def merge(cls, coefficients):
-        excludes = set()
-        results = []
-        coefficients = cls.copy(coefficients)
+        # groups the coefficients by (d_count, g_count, g2_count) in one pass, in the order of the first ones
+        groups = {}
         for c in coefficients:
             c: CoefficientReduced = c
-            if c in excludes:
-                continue
-            excludes.add(c)
-            cls.do_merge(c, coefficients, excludes)
-            results.append(c)
-        return results
+            key = c.key()
+            if key not in groups:
+                groups[key] = c.copy()
+            else:
+                groups[key].append(c)
+        return list(groups.values())
 
     @classmethod
     def copy(cls, coefficients):
@@ -81,13 +68,6 @@ class CoefficientMerger:
             results.append(c.copy())
         return results
 
-    @classmethod
-    def do_merge(cls, c, coefficients, excludes):
-        for c2 in coefficients:
-            if c2 not in excludes and c.is_appendable(c2):
-                excludes.add(c2)
-                c.append(c2)
-
 
 class CoefficientUtil:
     @classmethod
@@ -107,31 +87,27 @@ class ReportBuilder:
         self.network_map = None
         self.merged_map = None
         self.d_map = None
+        self.exact_map = None
 
     def build(self):
         self.network_map = self._build_network_map()
         self.merged_map = self._merge_coefficient()
         self.d_map = self._create_max_d_count()
+        self.exact_map = self._create_exact_map()
         return self
 
-    def to_html(self, path):
+    def to_html(self, path, workers=1):
+        # the images are named by the content of the networks, and the existing ones are not rendered again
         image_path = "{}/images".format(path)
         detail_path = "{}/details".format(path)
-        if not os.path.exists(path):
-            os.mkdir(path)
-            os.mkdir(image_path)
-            os.mkdir(detail_path)
-        else:
-            shutil.rmtree(path)
-            os.mkdir(path)
-            os.mkdir(image_path)
-            os.mkdir(detail_path)
-        for network, coeffs in self.network_map.items():
-            plt.clf()
-            network.draw()
-            plt.savefig("{}/{}".format(image_path, network.__hash__()))
-        for network in self.result.networks:
-            with open("{}/{}.html".format(detail_path, network.__hash__()), "w") as f:
+        for p in [path, image_path, detail_path]:
+            os.makedirs(p, exist_ok=True)
+        keys = {}
+        for network in self.network_map:
+            keys[network] = self.image_key(network)
+        self.render_images(image_path, keys, workers)
+        for network, key in keys.items():
+            with open("{}/{}.html".format(detail_path, key), "w") as f:
                 f.write("<html>")
                 f.write("<head>")
                 f.write(
@@ -142,7 +118,7 @@ class ReportBuilder:
                 f.write("</head>")
                 f.write("<h1>Detail</h1>\n")
                 f.write("<img src='../../{}/{}.png' width=400></img>\n"
-                        .format(image_path, network.__hash__()))
+                        .format(image_path, key))
                 f.write("<table class='table table-bordered'>")
                 coeffs = self.network_map[network]
                 f.write("<tr><th>Coefficient</th><th>approximate_d_count</th><th>Histories</th></tr>\n")
@@ -165,20 +141,41 @@ class ReportBuilder:
             for network, d_count in sorted(self.d_map.items(), key=lambda v: -v[1]):
                 f.write("<tr>")
                 f.write("<td><img src='../{}/{}.png' width=300></img></td>\n"
-                        .format(image_path, network.__hash__()))
+                        .format(image_path, keys[network]))
                 f.write("<td>{}</td>".format(d_count))
-                f.write("<td><a href='details/{}.html'>detail</a></td>".format(network.__hash__()))
+                f.write("<td><a href='details/{}.html'>detail</a></td>".format(keys[network]))
                 f.write("<tr>")
             f.write("</table>")
             f.write("</html>")
 
+    @classmethod
+    def image_key(cls, network: TensorNetwork):
+        # stable over the processes and the runs, unlike __hash__ which collides
+        return hashlib.sha1(repr(network.canonical()).encode("utf-8")).hexdigest()[:20]
+
+    @classmethod
+    def render_images(cls, image_path, keys, workers=1):
+        jobs = []
+        for network, key in keys.items():
+            file = "{}/{}.png".format(image_path, key)
+            if not os.path.exists(file):
+                jobs.append((network, file))
+        # the images are rendered in this process by default, and in a pool of the processes for workers > 1
+        if workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                _render_image(job)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(_render_image, jobs, chunksize=max(1, len(jobs) // (4 * workers))):
+                pass
+
     def _build_network_map(self):
         network_map = {}
         for i, network in enumerate(self.result.networks):
             coeff = self.result.coefficients[i]
-            if network not in network_map:
-                network_map[network] = []
-            network_map[network].append(CoefficientInterpreter.interpret(coeff))
+            coeffs = network_map.setdefault(network, [])
+            for c in coeff.coefficients():
+                coeffs.append(CoefficientInterpreter.interpret(c))
         return network_map
 
     def _merge_coefficient(self):
@@ -195,3 +192,25 @@ class ReportBuilder:
         for network, merged in self.merged_map.items():
             result[network] = CoefficientUtil.get_max_dcount(merged)
         return result
+
+    def _create_exact_map(self):
+        result = {}
+        for network, merged in self.merged_map.items():
+            result[network] = sum((c.to_rational() for c in merged), RationalFunction())
+        return result
+
+
+def _render_image(job):
+    # the figure is drawn on the Agg canvas, so that the images are rendered without a display
+    # both in this process and in the workers, and the backend of pyplot is kept as it is
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    network, file = job
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    network.draw(ax=ax)
+    # written to a temporary file first, so that a broken image is not taken as rendered
+    tmp = "{}.{}.tmp".format(file, os.getpid())
+    fig.savefig(tmp, format="png")
+    os.replace(tmp, file)
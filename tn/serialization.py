@@ -0,0 +1,250 @@
+from tn.core import *
+import gc
+import io
+import struct
+import zlib
+
+
+class SerializationException(Exception):
+    pass
+
+
+class NetworksSerializer:
+    # versioned and compressed serialization of TensorNetworks: MAGIC + version byte + body, where the body is
+    # a zlib stream of binary records, written and read entry by entry with NetworksWriter/NetworksReader
+    MAGIC = b"TNNS"
+    VERSION = 3
+
+    @classmethod
+    def dumps(cls, networks: TensorNetworks):
+        f = io.BytesIO()
+        with NetworksWriter(f, merge=networks.merge) as writer:
+            for i, network in enumerate(networks.networks):
+                writer.write(networks.coefficients[i], network)
+        return f.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        return NetworksReader(io.BytesIO(data)).read_all()
+
+    @classmethod
+    def restore_merge(cls, networks: TensorNetworks):
+        # the entries are already merged, so the index is rebuilt without merging them again
+        networks.merge = True
+        for i, network in enumerate(networks.networks):
+            networks._index[network.canonical()] = i
+
+    @classmethod
+    def new_coefficient(cls, digit, d_count, g_count, g2_count, histories):
+        c = Coefficient(digit, [])
+        c.d_count = d_count
+        c.g_count = g_count
+        c.g2_count = g2_count
+        c.histories = tuple(histories)
+        return c
+
+    @classmethod
+    def new_coefficient_of(cls, is_sum, coefficients):
+        if not is_sum:
+            return coefficients[0]
+        result = CoefficientSum()
+        for c in coefficients:
+            result.terms[c.key()] = c
+        return result
+
+    @classmethod
+    def new_network(cls, mhalf, b_height, depth, gates, edges):
+        result = TensorNetwork(mhalf, b_height, depth)
+        nodes = []
+        for x, y_start, y_end, t, dagger, group_id in gates:
+            gate = Gate(Location(x, y_start, y_end), group_id, TYPES[t], dagger=dagger)
+            result.add_node(gate)
+            nodes.append(gate)
+        for left, lj, right, rj in edges:
+            result.add_edge(nodes[left].get_plug(Direction.Right, lj), nodes[right].get_plug(Direction.Left, rj))
+        return result
+
+
+# tags of the values
+INT = 0
+BIG_INT = 1
+FLOAT = 2
+COMPLEX = 3
+STR = 4
+# tags of the records
+END = 0
+ENTRY = 1
+
+INT_RANGE = 1 << 63
+
+
+class NetworksWriter:
+    # header: MAGIC + version, then in the zlib stream: merge flag, step, n_steps, source, and the records
+    # ENTRY + coefficient + network, terminated by END. the step, n_steps and the source are used by the checkpoints.
+    CHUNK = 1 << 16
+
+    def __init__(self, f, merge=False, step=-1, source="", n_steps=-1):
+        self.f = f
+        self._compressor = zlib.compressobj()
+        self._buffer = bytearray()
+        f.write(NetworksSerializer.MAGIC + bytes([NetworksSerializer.VERSION]))
+        self._buffer += struct.pack("<?ii", merge, step, n_steps)
+        self._value(source)
+
+    def write(self, coeff, network: TensorNetwork):
+        self._buffer.append(ENTRY)
+        self._coefficient(coeff)
+        self._network(network)
+        if len(self._buffer) >= self.CHUNK:
+            self._flush()
+
+    def close(self):
+        self._buffer.append(END)
+        self._flush()
+        self.f.write(self._compressor.flush())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def _flush(self):
+        self.f.write(self._compressor.compress(bytes(self._buffer)))
+        self._buffer = bytearray()
+
+    def _coefficient(self, coeff):
+        terms = coeff.coefficients()
+        self._buffer += struct.pack("<?I", isinstance(coeff, CoefficientSum), len(terms))
+        for c in terms:
+            self._value(c.digit)
+            self._buffer += struct.pack("<iiiB", c.d_count, c.g_count, c.g2_count, len(c.histories))
+            for label in c.histories:
+                self._value(label)
+
+    def _network(self, network: TensorNetwork):
+        indices = {}
+        self._buffer += struct.pack("<iiiI", network.mhalf, network.b_height, network.depth, len(network.node_map))
+        for i, gate in enumerate(network.nodes()):
+            indices[id(gate)] = i
+            loc = gate.get_location()
+            self._buffer += struct.pack("<iiiB?", loc.x, loc.y_start, loc.y_end, gate.type.hash, gate.dagger)
+            self._value(gate.group_id)
+        self._buffer += struct.pack("<I", len(network.edge_map))
+        for edge in network.edge_map.values():
+            self._buffer += struct.pack("<IiIi", indices[id(edge.left_plug.gate)], edge.left_plug.j,
+                                        indices[id(edge.right_plug.gate)], edge.right_plug.j)
+
+    def _value(self, value):
+        if isinstance(value, int):
+            if -INT_RANGE <= value < INT_RANGE:
+                self._buffer += struct.pack("<Bq", INT, value)
+            else:
+                data = value.to_bytes((value.bit_length() + 8) // 8, "little", signed=True)
+                self._buffer += struct.pack("<BI", BIG_INT, len(data)) + data
+        elif isinstance(value, float):
+            self._buffer += struct.pack("<Bd", FLOAT, value)
+        elif isinstance(value, complex):
+            self._buffer += struct.pack("<Bdd", COMPLEX, value.real, value.imag)
+        elif isinstance(value, str):
+            data = value.encode("utf-8")
+            self._buffer += struct.pack("<BI", STR, len(data)) + data
+        else:
+            raise SerializationException("unsupported value {}".format(value))
+
+
+class NetworksReader:
+    CHUNK = 1 << 16
+
+    def __init__(self, f):
+        self.f = f
+        header = f.read(len(NetworksSerializer.MAGIC) + 1)
+        if header[:len(NetworksSerializer.MAGIC)] != NetworksSerializer.MAGIC:
+            raise SerializationException("not a serialized TensorNetworks")
+        version = header[len(NetworksSerializer.MAGIC)]
+        if version != NetworksSerializer.VERSION:
+            raise SerializationException("unsupported version {}".format(version))
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b""
+        self._position = 0
+        self.merge, self.step, self.n_steps = self._unpack("<?ii")
+        self.source = self._value()
+
+    def __iter__(self):
+        while True:
+            tag, = self._unpack("<B")
+            if tag == END:
+                return
+            yield self._coefficient(), self._network()
+
+    def read_all(self):
+        # the cyclic gc is paused while the networks are built, since the gates and the plugs refer to each other
+        # and the collections triggered by the allocations take most of the time
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            result = TensorNetworks()
+            for coeff, network in self:
+                result.add(coeff, network)
+        finally:
+            if enabled:
+                gc.enable()
+        if self.merge:
+            NetworksSerializer.restore_merge(result)
+        return result
+
+    def _coefficient(self):
+        is_sum, n_terms = self._unpack("<?I")
+        coefficients = []
+        for _ in range(n_terms):
+            digit = self._value()
+            d_count, g_count, g2_count, n_histories = self._unpack("<iiiB")
+            histories = [self._value() for _ in range(n_histories)]
+            coefficients.append(NetworksSerializer.new_coefficient(digit, d_count, g_count, g2_count, histories))
+        return NetworksSerializer.new_coefficient_of(is_sum, coefficients)
+
+    def _network(self):
+        mhalf, b_height, depth, n_gates = self._unpack("<iiiI")
+        gates = []
+        for _ in range(n_gates):
+            x, y_start, y_end, t, dagger = self._unpack("<iiiB?")
+            gates.append((x, y_start, y_end, t, dagger, self._value()))
+        n_edges, = self._unpack("<I")
+        edges = [self._unpack("<IiIi") for _ in range(n_edges)]
+        return NetworksSerializer.new_network(mhalf, b_height, depth, gates, edges)
+
+    def _value(self):
+        tag, = self._unpack("<B")
+        if tag == INT:
+            return self._unpack("<q")[0]
+        elif tag == BIG_INT:
+            n, = self._unpack("<I")
+            return int.from_bytes(self._read(n), "little", signed=True)
+        elif tag == FLOAT:
+            return self._unpack("<d")[0]
+        elif tag == COMPLEX:
+            real, imag = self._unpack("<dd")
+            return complex(real, imag)
+        elif tag == STR:
+            n, = self._unpack("<I")
+            return self._read(n).decode("utf-8")
+        raise SerializationException("unknown tag {}".format(tag))
+
+    def _unpack(self, fmt):
+        return struct.unpack(fmt, self._read(struct.calcsize(fmt)))
+
+    def _read(self, n):
+        while len(self._buffer) - self._position < n:
+            data = self.f.read(self.CHUNK)
+            if len(data) == 0:
+                raise SerializationException("truncated data")
+            try:
+                data = self._decompressor.decompress(data)
+            except zlib.error as e:
+                raise SerializationException("broken data: {}".format(e))
+            self._buffer = self._buffer[self._position:] + data
+            self._position = 0
+        result = self._buffer[self._position:self._position + n]
+        self._position = self._position + n
+        return result
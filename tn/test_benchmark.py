@@ -0,0 +1,19 @@
+from unittest import TestCase
+from tn.benchmark import *
+import os
+import tempfile
+
+
+class TestBenchmark(TestCase):
+    def test_dump(self):
+        benchmark = Benchmark([BenchmarkCase(2, 2, 0, 1, "var"), BenchmarkCase(2, 2, 0, 1, "avg")])
+        with tempfile.TemporaryDirectory() as path:
+            file = os.path.join(path, "benchmark.json")
+            benchmark.dump(file)
+            with open(file) as f:
+                result = json.load(f)
+        self.assertEqual(2, len(result["results"]))
+        for r in result["results"]:
+            self.assertTrue(len(r["steps"]) > 0)
+            self.assertEqual(r["networks"], r["steps"][-1]["networks_out"])
+            self.assertTrue(r["allocations"]["peak_bytes"] > 0)
@@ -0,0 +1,35 @@
+from unittest import TestCase
+from tn.cache import *
+import tempfile
+
+
+class TestResultCache(TestCase):
+    def test_compute(self):
+        circuit = ALTGenerator.generate(2, 2, 0, 1)
+        with tempfile.TemporaryDirectory() as path:
+            cache = ResultCache(path)
+            result = cache.compute(circuit, "var", 2.0, 1, HaarIntegration(6))
+            cached = cache.compute(circuit, "var", 2.0, 1, HaarIntegration(6))
+            self.assertEqual(1, len(os.listdir(path)) - 1)
+            self.assertEqual([n.canonical() for n in result.networks], [n.canonical() for n in cached.networks])
+            self.assertEqual([c.key() for c in result.coefficients], [c.key() for c in cached.coefficients])
+            self.assertEqual([c.digit for c in result.coefficients], [c.digit for c in cached.coefficients])
+            self.assertNotEqual(ResultCache.key(circuit, "var", 2.0, 1, HaarIntegration(6)),
+                                ResultCache.key(circuit, "var", 2.0, 1, HaarIntegration(6, merge=True)))
+            self.assertNotEqual(ResultCache.key(circuit, "var", 2.0, 1, HaarIntegration(6)),
+                                ResultCache.key(circuit, "var", 2.0, 1, HaarIntegration(6, prune=True)))
+            self.assertNotEqual(ResultCache.key(circuit, "var", 2.0, 1, HaarIntegration(6, prune=True)),
+                                ResultCache.key(circuit, "var", 2.0, 1, HaarIntegration(6, prune=True, slack=2)))
+            self.assertEqual(ResultCache.key(circuit, "var", 2.0, 1, HaarIntegration(6)),
+                             ResultCache.key(circuit, "var", 2.0, 1, HaarIntegration(6, workers=2, depth_first=True)))
+
+    def test_evict(self):
+        circuit = ALTGenerator.generate(2, 2, 0, 1)
+        with tempfile.TemporaryDirectory() as path:
+            cache = ResultCache(path)
+            cache.compute(circuit, "avg", 2.0, 1, HaarIntegration(6))
+            cache.max_bytes = cache.size()
+            cache.compute(circuit, "avg", 3.0, 1, HaarIntegration(6))
+            self.assertLessEqual(cache.size(), cache.max_bytes)
+            self.assertIsNone(cache.get(ResultCache.key(circuit, "avg", 2.0, 1, HaarIntegration(6))))
+            self.assertIsNotNone(cache.get(ResultCache.key(circuit, "avg", 3.0, 1, HaarIntegration(6))))
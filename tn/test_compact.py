@@ -0,0 +1,21 @@
+from unittest import TestCase
+from tn.circuit import *
+from tn.compact import *
+
+
+class TestCompactTensorNetwork(TestCase):
+    def test_round_trip(self):
+        network = ALTGenerator.generate(2, 3, 0, 1).to_grad_var(2.0, 1).networks[1]
+        compact = CompactTensorNetwork.from_network(network)
+        self.assertEqual(network.canonical(), compact.to_network().canonical())
+        self.assertEqual(len(network.node_map), len(compact.gate_x))
+
+    def test_copy(self):
+        network = ALTGenerator.generate(2, 2, 0, 1).to_grad_avg(2.0, 1).networks[0]
+        compact = CompactTensorNetwork.from_network(network)
+        copied = compact.copy()
+        # the first unitary of the first layer, whose four plugs are connected
+        copied.remove_gate(1)
+        self.assertEqual(network.canonical(), compact.to_network().canonical())
+        self.assertEqual(len(network.node_map) - 1, len(copied.to_network().node_map))
+        self.assertEqual(len(network.edge_map) - 4, len(copied.to_network().edge_map))
@@ -0,0 +1,43 @@
+from unittest import TestCase
+from tn.core import *
+import os
+import subprocess
+import sys
+
+
+class TestCoefficient(TestCase):
+    def test_extend(self):
+        c = Coefficient(2, [Factor.HIST_B])
+        c.extend([Factor.G, Factor.DF, Factor.MI, Factor.HIST3])
+        c.extend([Factor.G2, Factor.D2, Factor.HIST1])
+        self.assertEqual(-2, c.digit)
+        self.assertEqual((1, 1, 1), c.key())
+        self.assertEqual(("b", "3", "1"), c.histories)
+        copied = c.copy()
+        copied.add(Factor.D)
+        self.assertEqual((1, 1, 1), c.key())
+        self.assertEqual((2, 1, 1), copied.key())
+
+
+class TestRationalFunction(TestCase):
+    def test_add(self):
+        # D^2/(D^2-1) - 1/(D^2-1) = 1
+        r = Coefficient(1, [Factor.D2, Factor.G]).to_rational() + Coefficient(-1, [Factor.G]).to_rational()
+        self.assertEqual(RationalFunction({0: 1}), r)
+        self.assertEqual(0, r.g)
+        # D^2/(D^4-1) + 1/(D^4-1) = 1/(D^2-1)
+        r = Coefficient(1, [Factor.D2, Factor.G2]).to_rational() + Coefficient(1, [Factor.G2]).to_rational()
+        self.assertEqual(RationalFunction({0: 1}, 1, 0), r)
+        self.assertEqual((1, 0), (r.g, r.h))
+
+    def test_cancel(self):
+        r = Coefficient(1, [Factor.DF, Factor.G]).to_rational() + Coefficient(-1, [Factor.DF, Factor.G]).to_rational()
+        self.assertTrue(r.is_zero())
+
+
+class TestImport(TestCase):
+    def test_lazy_plotting(self):
+        code = "import sys, tn.computation, tn.report; print('matplotlib' in sys.modules or 'networkx' in sys.modules)"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual("False", output.stdout.strip())
@@ -0,0 +1,51 @@
+from unittest import TestCase
+from tn.circuit import *
+from tn.computation import *
+from tn.numeric import *
+from tn.report import *
+from fractions import Fraction
+
+
+class TestNumericEvaluator(TestCase):
+    def test_evaluate(self):
+        ms = np.array([1.0, 2.0, 3.0])
+        rational = Coefficient(-3, [Factor.D2, Factor.G]).to_rational() + Coefficient(2, [Factor.DF, Factor.G2]).to_rational()
+        d = np.exp2(ms)
+        expected = -3 * d ** 2 / (d ** 2 - 1) + 2 / d / (d ** 4 - 1)
+        np.testing.assert_allclose(expected, NumericEvaluator(ms).evaluate(rational).values())
+
+    def test_large_m(self):
+        evaluation = NumericEvaluator([2000.0]).evaluate(Coefficient(1, [Factor.D4, Factor.G]).to_rational())
+        np.testing.assert_allclose([2 * 2000.0], evaluation.log2_abs)
+
+    def test_big_int(self):
+        # the coefficients larger than 2^64 are evaluated without converting them to the floats
+        ms = [1.0, 2.0, 10.0, 100.0]
+        rational = RationalFunction({0: 2 ** 70, 1: -3 * 2 ** 65, 3: 5 ** 40}, 2, 1)
+        evaluation = NumericEvaluator(ms).evaluate(rational)
+        for i, m in enumerate(ms):
+            d = 2 ** int(m)
+            value = Fraction(2 ** 70 - 3 * 2 ** 65 * d + 5 ** 40 * d ** 3, (d ** 2 - 1) ** 2 * (d ** 2 + 1))
+            self.assertEqual(1 if value > 0 else -1, evaluation.phase[i])
+            self.assertAlmostEqual(math.log2(abs(value.numerator)) - math.log2(value.denominator),
+                                   evaluation.log2_abs[i])
+        evaluation = NumericEvaluator(ms).evaluate(RationalFunction({0: -2 ** 300}))
+        np.testing.assert_allclose([300.0] * 4, evaluation.log2_abs)
+        np.testing.assert_allclose([-1.0] * 4, evaluation.phase)
+
+    def test_cancellation(self):
+        # -2^200 + (2^199 + 1) D is 2 at D = 2, which is lost in the floats
+        rational = RationalFunction({0: -2 ** 200, 1: 2 ** 199 + 1})
+        evaluation = NumericEvaluator([1.0, 2.0]).evaluate(rational)
+        np.testing.assert_allclose([1.0, math.log2(2 ** 200 + 4)], evaluation.log2_abs)
+        np.testing.assert_allclose([1.0, 1.0], evaluation.phase)
+
+    def test_evaluate_map(self):
+        result = HaarIntegration(6).compute(ALTGenerator.generate(2, 2, 0, 1).to_grad_var(2.0, 1))
+        builder = ReportBuilder(result).build()
+        ms = np.arange(1, 50)
+        evaluator = NumericEvaluator(ms)
+        evaluations = evaluator.evaluate_map(builder.merged_map)
+        self.assertEqual(set(builder.merged_map), set(evaluations))
+        for network, evaluation in evaluations.items():
+            np.testing.assert_allclose(evaluator.evaluate(builder.exact_map[network]).values(), evaluation.values())
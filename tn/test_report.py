@@ -0,0 +1,53 @@
+from unittest import TestCase
+from tn.circuit import *
+from tn.computation import *
+from tn.report import *
+import os
+import tempfile
+import matplotlib.pyplot as plt
+
+
+class TestCoefficientMerger(TestCase):
+    def test_merge(self):
+        coefficients = [CoefficientReduced(1, 2, 1, 0, ["a"]), CoefficientReduced(3, 0, 0, 1, ["b"]),
+                        CoefficientReduced(-2, 2, 1, 0, ["c"]), CoefficientReduced(1, 0, 0, 1, [])]
+        merged = CoefficientMerger.merge(coefficients)
+        self.assertEqual([(2, 1, 0), (0, 0, 1)], [c.key() for c in merged])
+        self.assertEqual([-1, 4], [c.digit for c in merged])
+        self.assertEqual(1, coefficients[0].digit)
+
+    def test_build(self):
+        result = HaarIntegration(6).compute(ALTGenerator.generate(2, 2, 0, 1).to_grad_var(2.0, 1))
+        builder = ReportBuilder(result).build()
+        canonicals = set(network.canonical() for network in result.networks)
+        self.assertEqual(len(canonicals), len(builder.network_map))
+        for network, merged in builder.merged_map.items():
+            self.assertEqual(len(merged), len(set(c.key() for c in merged)))
+            total = sum(c.digit for c in builder.network_map[network])
+            self.assertEqual(total, sum(c.digit for c in merged))
+
+    def test_to_html(self):
+        result = HaarIntegration(6).compute(ALTGenerator.generate(2, 2, 0, 1).to_grad_avg(2.0, 1))
+        builder = ReportBuilder(result).build()
+        with tempfile.TemporaryDirectory() as path:
+            backend = plt.get_backend()
+            builder.to_html(path)
+            # rendered in this process on the Agg canvas, without the figures of pyplot
+            self.assertEqual(backend, plt.get_backend())
+            self.assertEqual([], plt.get_fignums())
+            images = os.listdir(os.path.join(path, "images"))
+            self.assertEqual(len(builder.network_map), len(images))
+            mtimes = [os.stat(os.path.join(path, "images", f)).st_mtime_ns for f in images]
+            builder.to_html(path, workers=1)
+            self.assertEqual(mtimes, [os.stat(os.path.join(path, "images", f)).st_mtime_ns for f in images])
+            self.assertTrue(os.path.exists(os.path.join(path, "index.html")))
+
+    def test_render_images(self):
+        # rendered by a pool of the processes
+        result = HaarIntegration(6).compute(ALTGenerator.generate(2, 2, 0, 1).to_grad_avg(2.0, 1))
+        builder = ReportBuilder(result).build()
+        keys = {network: ReportBuilder.image_key(network) for network in builder.network_map}
+        self.assertLess(1, len(set(keys.values())))
+        with tempfile.TemporaryDirectory() as path:
+            ReportBuilder.render_images(path, keys, workers=2)
+            self.assertEqual(set("{}.png".format(key) for key in keys.values()), set(os.listdir(path)))
@@ -0,0 +1,39 @@
+from unittest import TestCase
+from tn.circuit import *
+from tn.computation import *
+from tn.serialization import *
+import io
+
+
+class TestNetworksSerializer(TestCase):
+    def test_round_trip(self):
+        circuit = ALTGenerator.generate(2, 2, 0, 1)
+        for networks in [HaarIntegration(6, merge=True).compute(circuit.to_grad_var(2.0, 1)),
+                         HaarIntegration(6).compute(circuit.to_grad_avg(2.0, 1))]:
+            loaded = NetworksSerializer.loads(NetworksSerializer.dumps(networks))
+            self.assertEqual(networks.merge, loaded.merge)
+            self.assertEqual([n.canonical() for n in networks.networks], [n.canonical() for n in loaded.networks])
+            for c, c2 in zip(networks.coefficients, loaded.coefficients):
+                self.assertEqual([(t.digit, t.key(), t.histories) for t in c.coefficients()],
+                                 [(t.digit, t.key(), t.histories) for t in c2.coefficients()])
+
+    def test_stream(self):
+        networks = ALTGenerator.generate(2, 2, 0, 1).to_grad_var(2.0, 1)
+        networks.coefficients[0].digit = -(1 << 80)
+        f = io.BytesIO()
+        writer = NetworksWriter(f, step=3, source="abc", n_steps=5)
+        writer.CHUNK = 16
+        for i, network in enumerate(networks.networks):
+            writer.write(networks.coefficients[i], network)
+        writer.close()
+        f.seek(0)
+        reader = NetworksReader(f)
+        reader.CHUNK = 16
+        self.assertEqual((3, 5, "abc"), (reader.step, reader.n_steps, reader.source))
+        entries = list(reader)
+        self.assertEqual(-(1 << 80), entries[0][0].digit)
+        self.assertEqual([n.canonical() for n in networks.networks], [n.canonical() for _, n in entries])
+        with self.assertRaises(SerializationException):
+            NetworksSerializer.loads(f.getvalue()[:-8])
+        with self.assertRaises(SerializationException):
+            NetworksSerializer.loads(NetworksSerializer.MAGIC + bytes([2]) + f.getvalue()[5:])
@@ -0,0 +1,63 @@
+from unittest import TestCase
+from tn.circuit import *
+from tn.computation import *
+from tn.transfer import *
+
+
+class TestTransferMatrixIntegration(TestCase):
+    def test_var(self):
+        circuit = ALTGenerator.generate(2, 3, 1, 2)
+        for grad_id in [1.3333333333333333, 2.5, 4.0]:
+            expected = HaarIntegration(20, merge=True).compute(circuit.to_grad_var(grad_id, 1))
+            result = TransferMatrixIntegration("var").compute(circuit, grad_id, 1)
+            self.assertEqual(self._rationals(expected), self._rationals(result))
+
+    def test_avg(self):
+        circuit = ALTGenerator.generate(2, 4, 0, 1)
+        expected = HaarIntegration(20, merge=True).compute(circuit.to_grad_avg(2.5, 1))
+        result = TransferMatrixIntegration("avg").compute(circuit, 2.5, 1)
+        self.assertEqual(self._rationals(expected), self._rationals(result))
+
+    def test_evaluate(self):
+        circuit = ALTGenerator.generate(2, 6, 0, 1)
+        ms = np.array([1.0, 2.0, 10.0, 100.0])
+        integration = TransferMatrixIntegration()
+        expected = self._rationals(integration.compute(circuit, 2.5, 1))
+        evaluator = NumericEvaluator(ms)
+        for network, evaluation in integration.evaluate(circuit, 2.5, 1, ms):
+            e = evaluator.evaluate(expected[network.canonical()])
+            np.testing.assert_allclose(e.log2_abs, evaluation.log2_abs)
+            np.testing.assert_allclose(e.phase, evaluation.phase)
+
+    def test_deep(self):
+        # the coefficients are far larger than 2^64 and cancel at small m, so a sample of the networks is checked
+        # with the integers. all the coefficients of the sweep have the same denominator
+        circuit = ALTGenerator.generate(2, 100, 0, 1)
+        ms = [1, 10, 100]
+        integration = TransferMatrixIntegration()
+        result = integration.compute(circuit, 50.5, 1)
+        evaluations = integration.evaluate(circuit, 50.5, 1, np.array(ms, dtype=float))
+        # the terms have the same denominator and different powers of D, so the sums are zero only if they all are
+        n_nonzero = sum(1 for coeff in result.coefficients if any(c.digit != 0 for c in coeff.coefficients()))
+        self.assertEqual(n_nonzero, len(evaluations))
+        indices = {network.canonical(): i for i, network in enumerate(result.networks)}
+        for network, evaluation in evaluations[::len(evaluations) // 16]:
+            terms = result.coefficients[indices[network.canonical()]].coefficients()
+            low = min(c.d_count for c in terms)
+            for j, m in enumerate(ms):
+                numerator = sum(c.digit << (m * (c.d_count - low)) for c in terms)
+                log2_abs = math.log2(abs(numerator)) + m * low \
+                    - terms[0].g_count * math.log2(4 ** m - 1) - terms[0].g2_count * math.log2(16 ** m - 1)
+                self.assertAlmostEqual(log2_abs, evaluation.log2_abs[j])
+                self.assertEqual(1 if numerator > 0 else -1, evaluation.phase[j])
+
+    @classmethod
+    def _rationals(cls, networks):
+        result = {}
+        for i, network in enumerate(networks.networks):
+            key = network.canonical()
+            rational = result.get(key, RationalFunction())
+            for c in networks.coefficients[i].coefficients():
+                rational = rational + c.to_rational()
+            result[key] = rational
+        return {k: v for k, v in result.items() if not v.is_zero()}
@@ -0,0 +1,268 @@
+from tn.circuit import *
+from tn.numeric import *
+
+# boundary records
+EARLY = "early"
+LATE = "late"
+DIRECT = "direct"
+FOLD = "fold"
+
+
+class TransferMatrixIntegration:
+    # Haar integration of the unitaries of a circuit as a sum over the permutations of the copies.
+    # each integrated gate has a permutation on its left (sigma) and right (tau) side with the Weingarten weight,
+    # and a wire between two integrated gates gives D^(number of cycles). the circuit is swept layer by layer
+    # with the permutations on the open wires as the state, so that the cost is linear in the depth.
+    # the permutations next to the gates that are not integrated (the initial state, the observable and
+    # the gradient) are kept in the state, and give the networks of the result.
+    #
+    # the values are polynomials of x = 1/D, where the weights are
+    #   gate: 1/(D^2r-1) x (1 if sigma == tau else -x^r), wire: D^2 x (1 if the same else x)
+    # for two copies (kind = "var"), and gate: x^r, wire: D for one copy (kind = "avg").
+    # the denominators and the powers of D are counted in the sweep.
+    #
+    # a polynomial sum_k c_k x^k is packed into the integer sum_k c_k 2^(bits k), so that adding two
+    # polynomials is one addition of integers and multiplying by x^e is a shift. the sum of |c_k| over all the
+    # states grows at most by len(perms)^2 for each integrated gate, which gives the bits that keep the
+    # coefficients apart. the bound is about twice as wide as the coefficients in practice.
+    # for n_blk = 2 and depth = 100, compute and evaluate take about 7 s each (about 20 s with dicts of
+    # the coefficients), most of which is the shifts and the additions of the packed integers.
+    def __init__(self, kind="var"):
+        if kind not in ("var", "avg"):
+            raise InvalidVariableException("kind should be var or avg")
+        self.kind = kind
+        self.copies = 2 if kind == "var" else 1
+        self.perms = [(0, 1), (1, 0)] if self.copies == 2 else [(0,)]
+
+    def compute(self, circuit: Circuit, grad_id, mhalf) -> TensorNetworks:
+        sweep = self._sweep(circuit, grad_id)
+        result = TensorNetworks(merge=True)
+        initial = self._networks(circuit, grad_id, mhalf)
+        terms = {records: sweep.terms(poly) for records, poly in sweep.values.items()}
+        for i, network in enumerate(initial.networks):
+            digit = initial.coefficients[i].digit
+            for records, poly in terms.items():
+                coeff = CoefficientSum()
+                for k, v in poly.items():
+                    c = Coefficient(digit * v, [])
+                    c.d_count = sweep.d_count - k
+                    c.g_count = sweep.g_count
+                    c.g2_count = sweep.g2_count
+                    # the exponents are different, so are the keys
+                    coeff.terms[c.key()] = c
+                result.add(coeff, self._residual(circuit, network, sweep.descriptors, records))
+        return result
+
+    def evaluate(self, circuit: Circuit, grad_id, mhalf, ms):
+        # network -> Evaluation for each m. the networks share the denominator of the sweep,
+        # so the numerators are summed without RationalFunction.simplify
+        sweep = self._sweep(circuit, grad_id)
+        totals = {}
+        initial = self._networks(circuit, grad_id, mhalf)
+        terms = {records: sweep.terms(poly) for records, poly in sweep.values.items()}
+        for i, network in enumerate(initial.networks):
+            digit = initial.coefficients[i].digit
+            for records, poly in terms.items():
+                residual = self._residual(circuit, network, sweep.descriptors, records)
+                key = residual.canonical()
+                if key not in totals:
+                    totals[key] = (residual, {})
+                numerator = totals[key][1]
+                for k, v in poly.items():
+                    numerator[sweep.d_count - k] = numerator.get(sweep.d_count - k, 0) + digit * v
+        evaluator = NumericEvaluator(ms)
+        result = []
+        for residual, numerator in totals.values():
+            rational = RationalFunction(numerator, sweep.g_count + sweep.g2_count, sweep.g2_count)
+            if not rational.is_zero():
+                result.append((residual, evaluator.evaluate(rational)))
+        return result
+
+    def _networks(self, circuit: Circuit, grad_id, mhalf):
+        if self.kind == "var":
+            return circuit.to_grad_var(grad_id, mhalf)
+        return circuit.to_grad_avg(grad_id, mhalf)
+
+    def _sweep(self, circuit: Circuit, grad_id):
+        cone = circuit.light_cone(grad_id)
+        gates = [g for g in circuit.gates if id(g) in cone]
+        n_integrated = sum(1 for g in gates if g.type == Type.UNITARY and g.group_id != grad_id)
+        # |c_k| <= len(perms)^(2 n_integrated) < 2^(bits - 1)
+        bits = 8 * math.ceil((2 * n_integrated * math.ceil(math.log2(len(self.perms))) + 2) / 8)
+        sweep = _Sweep(circuit.b_height, self.copies, self.perms, bits)
+        layers = {}
+        for gate in gates:
+            layers.setdefault(gate.get_location().x, []).append(gate)
+        for x in sorted(layers):
+            for gate in layers[x]:
+                if gate.type == Type.UNITARY and gate.group_id != grad_id:
+                    sweep.integrate(gate)
+                else:
+                    sweep.boundary(gate)
+        sweep.observable(circuit.observable)
+        sweep.fold()
+        return sweep
+
+    def _residual(self, circuit: Circuit, network: TensorNetwork, descriptors, records):
+        # the network without the unitaries, whose wires are connected as the permutations in the records
+        result = TensorNetwork(network.mhalf, network.b_height, network.depth)
+        gates = {}
+        for gate in network.nodes():
+            if gate.type == Type.UNITARY:
+                continue
+            loc = gate.get_location()
+            gates[(loc.x, loc.y_start)] = gate.copy()
+            result.add_node(gates[(loc.x, loc.y_start)])
+        center = circuit.observable.get_location().x
+        offsets = [0, circuit.b_height + 1][:self.copies]
+
+        def forward(gate, k):
+            return gates[(gate.get_location().x, gate.get_location().y_start + offsets[k])]
+
+        def backward(gate, k):
+            return gates[(2 * center - gate.get_location().x, gate.get_location().y_start + offsets[k])]
+
+        def connect(left, right, w, k, l):
+            result.add_edge(left.get_plug(Direction.Right, w + offsets[k]),
+                            right.get_plug(Direction.Left, w + offsets[l]))
+
+        for descriptor, perm in zip(descriptors, records):
+            kind, a, b, w = descriptor
+            for k in range(self.copies):
+                if kind == EARLY:
+                    connect(forward(a, k), backward(a, perm[k]), w, k, perm[k])
+                elif kind == LATE:
+                    connect(backward(b, perm[k]), forward(b, k), w, perm[k], k)
+                elif kind == DIRECT:
+                    connect(forward(a, k), forward(b, k), w, k, k)
+                    connect(backward(b, k), backward(a, k), w, k, k)
+                else:
+                    connect(forward(a, k), backward(a, k), w, k, k)
+        return result
+
+
+class _Sweep:
+    # state: the permutation on the right of the last integrated gate of each wire (-1 for the other wires),
+    # and the permutations recorded next to the gates which are not integrated
+    LABEL = "label"
+
+    def __init__(self, b_height, copies, perms, bits):
+        self.copies = copies
+        self.perms = perms
+        # the packed coefficients are bits wide, a multiple of 8
+        self.bits = bits
+        # wire -> LABEL or the last gate which is not integrated
+        self.opens = {}
+        # the structure of the records, which are shared by all the states
+        self.descriptors = []
+        self.values = {(tuple([-1] * b_height), ()): 1}
+        # the power of D and the denominators taken out of the values
+        self.d_count = 0
+        self.g_count = 0
+        self.g2_count = 0
+
+    def integrate(self, gate: Gate):
+        ys = GateUtil.get_ys(gate)
+        r = len(ys)
+        inner = [y for y in ys if self.opens.get(y) == self.LABEL]
+        outer = [y for y in ys if y in self.opens and self.opens[y] != self.LABEL]
+        for y in outer:
+            self.descriptors.append((EARLY, self.opens[y], None, y))
+        if self.copies == 2:
+            self.d_count = self.d_count + 2 * len(inner)
+            if r == 1:
+                self.g_count = self.g_count + 1
+            else:
+                self.g2_count = self.g2_count + 1
+        else:
+            self.d_count = self.d_count + len(inner) - r
+        values = {}
+        for (state, records), value in self.values.items():
+            for sigma in range(len(self.perms)):
+                # a wire between two integrated gates gives D^2 for the same permutations and D otherwise
+                n_diff = sum(1 for y in inner if state[y] != sigma)
+                weighted = self._multiply(value, 1, n_diff)
+                recorded = records + tuple(self.perms[sigma] for y in outer)
+                for tau in range(len(self.perms)):
+                    # Weingarten weight
+                    if sigma == tau:
+                        v = weighted
+                    else:
+                        v = self._multiply(weighted, -1, r)
+                    after = list(state)
+                    for y in ys:
+                        after[y] = tau
+                    self._add(values, (tuple(after), recorded), v)
+        for y in ys:
+            self.opens[y] = self.LABEL
+        self.values = values
+
+    def boundary(self, gate: Gate):
+        ys = GateUtil.get_ys(gate)
+        self._close(gate, ys)
+        for y in ys:
+            self.opens[y] = gate
+
+    def observable(self, observable: Gate):
+        ys = GateUtil.get_ys(observable)
+        self._close(observable, ys)
+        for y in ys:
+            self.opens.pop(y, None)
+
+    def fold(self):
+        # the wires which are not connected to the observable are connected to their conjugates
+        inner = [y for y in sorted(self.opens) if self.opens[y] == self.LABEL]
+        outer = [y for y in sorted(self.opens) if self.opens[y] != self.LABEL]
+        self.d_count = self.d_count + self.copies * len(inner)
+        for y in outer:
+            self.descriptors.append((FOLD, self.opens[y], None, y))
+        values = {}
+        for (state, records), value in self.values.items():
+            n_diff = sum(1 for y in inner if state[y] != 0)
+            self._add(values, records + tuple(self.perms[0] for y in outer), self._multiply(value, 1, n_diff))
+        self.opens = {}
+        self.values = values
+
+    def _close(self, gate: Gate, ys):
+        # records the permutations on the left of a gate which is not integrated
+        ys = [y for y in ys if y in self.opens]
+        inner = [self.opens[y] == self.LABEL for y in ys]
+        for y, is_inner in zip(ys, inner):
+            if is_inner:
+                self.descriptors.append((LATE, None, gate, y))
+            else:
+                self.descriptors.append((DIRECT, self.opens[y], gate, y))
+        values = {}
+        for (state, records), value in self.values.items():
+            after = list(state)
+            for y in ys:
+                after[y] = -1
+            recorded = records + tuple(self.perms[state[y]] if is_inner else self.perms[0]
+                                       for y, is_inner in zip(ys, inner))
+            self._add(values, (tuple(after), recorded), value)
+        self.values = values
+
+    def terms(self, poly):
+        # exponent -> coefficient of a packed polynomial. half is added to each coefficient,
+        # so that they are all non-negative and are read from the bytes
+        width = self.bits // 8
+        n = poly.bit_length() // self.bits + 2
+        half = 1 << (self.bits - 1)
+        bias = half * (((1 << (self.bits * n)) - 1) // ((1 << self.bits) - 1))
+        data = (poly + bias).to_bytes(n * width, "little")
+        result = {}
+        for k in range(n):
+            c = int.from_bytes(data[k * width:(k + 1) * width], "little") - half
+            if c != 0:
+                result[k] = c
+        return result
+
+    def _multiply(self, poly, c, e):
+        # poly x c x^e, c is 1 or -1
+        if c == 1:
+            return poly << (self.bits * e)
+        return -(poly << (self.bits * e))
+
+    @classmethod
+    def _add(cls, values, key, poly):
+        values[key] = values.get(key, 0) + poly